@@ -6,6 +6,8 @@ import reconchess.utilities as rcu
 import logging
 import sys
 
+from improved.engines import EngineCache, CachedEngine, EnginePool
+
 stockfish_path = "/opt/homebrew/Cellar/stockfish/16.1/bin/stockfish"
 
 logger = logging.getLogger('sensing.random')
@@ -105,12 +107,20 @@ if __name__ == "__main__":
 
 
 class RandomSensing(rc.Player):
-    def __init__(self):
+    def __init__(self, engine_pool_size: int = 0, engine_cache_size: int = 100_000):
         self.colour = False
         self.my_board = None
         self.current_move = 0
         self.states = set()
 
+        # Size of the choose_move EnginePool, 0 for none
+        self.engine_pool_size = engine_pool_size
+        self.engine_pool = None
+
+        # Entries in the per game EngineCache, 0 for none
+        self.engine_cache_size = engine_cache_size
+        self.engine_cache = None
+
     # ReconChess Player Requirements
     def handle_game_start(self, color: chess.Color, board: chess.Board, opponent_name: str):
         self.colour = color
@@ -121,7 +131,12 @@ class RandomSensing(rc.Player):
         board.turn = self.colour
 
         self.my_board = rcu.without_opponent_pieces(board)
+        self.engine_cache = EngineCache(self.engine_cache_size) if self.engine_cache_size > 0 else None
         self.engine = chess.engine.SimpleEngine.popen_uci(stockfish_path, setpgrp=True)
+        if self.engine_cache is not None:
+            self.engine = CachedEngine(self.engine, self.engine_cache)
+        if self.engine_pool_size > 0:
+            self.engine_pool = EnginePool(stockfish_path, self.engine_pool_size, cache=self.engine_cache, setpgrp=True)
 
         self.states.add(board.board_fen())
 
@@ -189,6 +204,7 @@ class RandomSensing(rc.Player):
         logger.debug(f'Stockfish search:\t{len(self.states)} states at {10 / len(self.states) if len(self.states) != 0 else 1e6} seconds per state')
         board = chess.Board()
         selected_moves = {}
+        search_boards = []
         for state in self.states:
             board.set_board_fen(state)
             board.clear_stack()
@@ -200,6 +216,10 @@ class RandomSensing(rc.Player):
                 if opposing_king_square == move.to_square and move in move_actions:
                     return move
 
+            if self.engine_pool is not None:
+                search_boards.append(board.copy(stack=False))
+                continue
+
             try:
                 result = self.engine.play(board, chess.engine.Limit(time=10 / len(self.states) if len(self.states) != 0 else 1e6))
 
@@ -214,6 +234,19 @@ class RandomSensing(rc.Player):
             except chess.engine.EngineError:
                 logger.warning(f'Engine bad state {state}')
 
+        if self.engine_pool is not None:
+            # Same wall clock budget as searching one state at a time, spread over every engine in the pool
+            search_time = len(self.engine_pool) * 10 / len(search_boards) if len(search_boards) != 0 else 1e6
+            for result in self.engine_pool.play_many(search_boards, chess.engine.Limit(time=search_time)):
+                if result is None:
+                    continue
+
+                move_uci = result.move.uci() if result.move != None else '0000'
+                if move_uci not in selected_moves.keys():
+                    selected_moves[move_uci] = 1
+                else:
+                    selected_moves[move_uci] += 1
+
         nonexisting_moves = 0
         if len(selected_moves) != 0:
             moves_uci = []
@@ -256,3 +289,10 @@ class RandomSensing(rc.Player):
             self.engine.quit()
         except chess.engine.EngineTerminatedError:
             logger.error("Failed to terminate engine")
+
+        if self.engine_pool is not None:
+            self.engine_pool.quit()
+            self.engine_pool = None
+
+        if self.engine_cache is not None:
+            logger.debug(f'Engine cache:\t\t{self.engine_cache.stats()}')
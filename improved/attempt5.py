@@ -1,4 +1,5 @@
 import random
+import time
 import chess
 import chess.engine
 import reconchess as rc
@@ -6,12 +7,26 @@ import reconchess.utilities as rcu
 import logging
 import heapq
 import numpy as np
-import math as m
 import sys
+import os
+import itertools
+import array
+import multiprocessing
+import concurrent.futures
+
+from improved.belief import State, ArrayBelief, moved_codes, moved_squares, code_states, kept_counts, recount_squares, board_state, set_board_state, sense_pattern, matches_pattern, pattern_mismatches, state_keys, move_key
+from improved.belief import Belief, ParticleBelief, LazyBelief, NUM_PIECE_CODES, piece_code, state_codes, satisfying, square_entropy, window_sum, sense_information_gain
+from improved.engines import EngineCache, CachedEngine, EnginePool
+from improved.snapshot import save_snapshot, encode_arguments, Snapshot
+from improved.instrument import Instrument, instrumented, stage
+from improved.timing import TimeManager, EXPAND, SENSE, MOVE
 
 stockfish_path = "/opt/homebrew/Cellar/stockfish/16.1/bin/stockfish"
 
-def select_best_states(states: set[str], turn: chess.Color, engine: chess.engine.SimpleEngine, state_limits: list[int], evaluation_limits: list[int]) -> list[str]:
+# Shortest engine search given to a state, fewer states are searched rather than going below it
+MIN_SEARCH_TIME = 0.01
+
+def select_best_states(states: Belief, turn: chess.Color, engine: CachedEngine | chess.engine.SimpleEngine, state_limits: list[int], evaluation_limits: list[int], deadline: float | None = None, buckets: dict[State, int] | None = None) -> list[State]:
     """
         Not allowed to modify states variable
 
@@ -24,6 +39,10 @@ def select_best_states(states: set[str], turn: chess.Color, engine: chess.engine
             eval < evalulation_limits[0]: state that created eval is bad for turn
             evaluation_limits[1] < eval < evalulation_limits[2]: state that created eval is middle for turn
             evaluation_limits[3] < eval: state that created eval is good for turn
+
+        deadline -> time.time() after which no more states are analysed
+
+        buckets -> if given, filled with the index (into state_limits) of the bucket each selected state was picked for
     """
     assert(len(state_limits) == 3)
     assert(len(evaluation_limits) == 4)
@@ -40,65 +59,109 @@ def select_best_states(states: set[str], turn: chess.Color, engine: chess.engine
         selected_states = []
 
         for state in states:
-            state_evaluation = engine.analyse(board, chess.engine.Limit(depth=5))["score"].pov(turn).score(mate_score = 10_000)
+            set_board_state(board, state)
+            try:
+                state_evaluation = engine.analyse(board, chess.engine.Limit(depth=5))["score"].pov(turn).score(mate_score = 10_000)
+            except chess.engine.EngineError:
+                # Stockfish can reject a state (a king left in check by the previous move), it is just not selected
+                continue
 
             if state_evaluation < evaluation_limits[0] and counter_worst_states < state_limits[0]:
                 counter_worst_states += 1
                 selected_states.append(state)
+                if buckets is not None:
+                    buckets[state] = 0
             elif evaluation_limits[1] < state_evaluation and state_evaluation < evaluation_limits[2] and counter_middle_states < state_limits[1]:
                 counter_middle_states += 1
                 selected_states.append(state)
+                if buckets is not None:
+                    buckets[state] = 1
             elif state_evaluation > evaluation_limits[3] and counter_best_states < state_limits[2]:
                 counter_best_states += 1
                 selected_states.append(state)
+                if buckets is not None:
+                    buckets[state] = 2
 
             if len(selected_states) >= net_state_limit:
                 break
+            if deadline is not None and time.time() > deadline:
+                break
 
         return selected_states
     else:
         return possible_states
 
-def calculate_probabilites(states: set[str]) -> list[dict[chess.Piece, int]] | None:
-    num_states = len(states)
-    if num_states == 0:
-        return None
-
-    probabilites = [{}  for _ in chess.SQUARES]
+def priority_order(states: list[State], priority: dict[State, float]) -> list[State]:
+    """
+        states highest priority first, states of equal priority (or missing from priority) in random order
+    """
+    states = list(states)
+    random.shuffle(states)
+    states.sort(key=lambda state: priority.get(state, 0), reverse=True)
+
+    return states
+
+# Squares a piece_type of colour on square could move to on an empty board
+def piece_reach(piece_type: chess.PieceType, colour: chess.Color, square: chess.Square) -> int:
+    if piece_type == chess.PAWN:
+        return chess.BB_PAWN_ATTACKS[colour][square]
+    elif piece_type == chess.KNIGHT:
+        return chess.BB_KNIGHT_ATTACKS[square]
+    elif piece_type == chess.KING:
+        return chess.BB_KING_ATTACKS[square]
+
+    reach = chess.BB_EMPTY
+    if piece_type in (chess.BISHOP, chess.QUEEN):
+        reach |= chess.BB_DIAG_ATTACKS[square][chess.BB_EMPTY]
+    if piece_type in (chess.ROOK, chess.QUEEN):
+        reach |= chess.BB_RANK_ATTACKS[square][chess.BB_EMPTY] | chess.BB_FILE_ATTACKS[square][chess.BB_EMPTY]
+    return reach
+
+def king_capture_moves(codes: np.ndarray, colour: chess.Color, move_actions: list[chess.Move]) -> dict[chess.Move, int]:
+    """
+        For each of move_actions that captures the opposing king in some of the states with piece codes codes, the number of such states
+        A move captures the king in a state iff the state has one of colour's pieces that can reach to_square on from_square,
+        the king on to_square and nothing in between (pawns only capture diagonally)
+    """
+    king_code = piece_code(chess.Piece(chess.KING, not colour))
+    empty_code = piece_code(None)
 
-    board = chess.Board()
-    for state in states:
-        board.set_board_fen(state)
+    # Only the squares the king is on in some state are worth looking at
+    king_squares = np.count_nonzero(codes == king_code, axis=0)
 
-        for square in chess.SQUARES:
-            if probabilites[square] is None:
-                probabilites[square] = {}
+    captures = {}
+    for move in move_actions:
+        if king_squares[move.to_square] == 0:
+            continue
 
-            current_piece = board.piece_at(square)
-            if current_piece not in probabilites[square].keys():
-                probabilites[square][current_piece] = 1 / num_states
-            else:
-                probabilites[square][current_piece] += 1 / num_states
+        to_mask = chess.BB_SQUARES[move.to_square]
+        movers = [piece_code(chess.Piece(piece_type, colour)) for piece_type in chess.PIECE_TYPES if piece_reach(piece_type, colour, move.from_square) & to_mask]
+        if len(movers) == 0:
+            continue
 
-    return probabilites
+        capturing = (codes[:, move.to_square] == king_code) & np.isin(codes[:, move.from_square], movers)
+        for square in chess.scan_forward(chess.between(move.from_square, move.to_square)):
+            capturing &= codes[:, square] == empty_code
 
-def calculate_entropy(probabilites: list[dict[chess.Piece, int]]) -> np.array:
-    entropies = np.zeros(8 * 8)
-    convolved_entropies = np.zeros(8 * 8)
+        num_states = int(np.count_nonzero(capturing))
+        if num_states != 0:
+            captures[move] = num_states
 
-    for square in chess.SQUARES:
-        for pieces in probabilites[square].keys():
-            entropies[square] -= probabilites[square][pieces] * m.log(probabilites[square][pieces], 2)
+    return captures
 
-    kernel = [-9, -8, -7, -1, 0, 1, 7, 8, 9]
-    for square in chess.SQUARES:
-        for square_shift in kernel:
-            if square + square_shift >= 0 and square + square_shift < 64:
-                convolved_entropies[square] += entropies[square + square_shift]
+# Piece codes of every state in a belief, with their weights for a particle belief
+def belief_codes(states) -> tuple[np.ndarray, np.ndarray | None]:
+    if isinstance(states, LazyBelief):
+        return states.successor_codes(list(chess.SQUARES)), None
+    elif isinstance(states, ParticleBelief):
+        return state_codes(list(states.weights)), np.fromiter(states.weights.values(), dtype=float, count=len(states.weights))
+    elif isinstance(states, Belief):
+        return states.codes, None
 
-    convolved_entropies = np.reshape(convolved_entropies, (8,8))
+    return state_codes(list(states)), None
 
-    return convolved_entropies
+def calculate_entropy(probabilites: np.ndarray) -> np.ndarray:
+    return window_sum(square_entropy(probabilites))
 
 
 def generate_moves(board: chess.Board):
@@ -116,65 +179,611 @@ def generate_moves(board: chess.Board):
     return moves
 
 
+def move_result_clauses(colour: chess.Color, moved_piece: chess.PieceType, requested_move: chess.Move | None, taken_move: chess.Move | None, capture_square: chess.Square | None) -> list[list[tuple[chess.Square, list[int]]]]:
+    """
+        What the result of my move says about the opponent's pieces before it, as clauses for satisfying
+        (my pieces are known, so every constraint is on whether a square holds an opponent piece)
+
+        moved_piece -> type of my piece on requested_move.from_square
+    """
+    if requested_move is None or moved_piece is None:
+        return []
+
+    opponent = [piece_code(chess.Piece(piece_type, not colour)) for piece_type in chess.PIECE_TYPES]
+    not_opponent = [code for code in range(NUM_PIECE_CODES) if code not in opponent]
+
+    def holds_opponent(square: chess.Square) -> list[tuple[chess.Square, list[int]]]:
+        return [(square, opponent)]
+
+    def lacks_opponent(square: chess.Square) -> list[tuple[chess.Square, list[int]]]:
+        return [(square, not_opponent)]
+
+    castling = moved_piece == chess.KING and abs(requested_move.to_square - requested_move.from_square) == 2
+    if castling:
+        rook_square = chess.square(7 if requested_move.to_square > requested_move.from_square else 0, chess.square_rank(requested_move.from_square))
+        path = chess.SquareSet(chess.between(requested_move.from_square, rook_square))
+        if taken_move is None:
+            # move_actions only offers castles my own pieces and rights allow, so an opponent piece was in the way
+            return [[(square, opponent) for square in path]]
+        return [lacks_opponent(square) for square in path]
+
+    if taken_move is None:
+        # Only pawns can fail outright: a push into a piece or a diagonal onto an empty square
+        if requested_move.to_square % 8 == requested_move.from_square % 8:
+            return [holds_opponent(next(iter(chess.SquareSet(chess.between(requested_move.from_square, requested_move.to_square))), requested_move.to_square))]
+        return [lacks_opponent(requested_move.to_square)]
+
+    # The taken move was pseudo-legal on the true board, so nothing stood in its way
+    clauses = [lacks_opponent(square) for square in chess.SquareSet(chess.between(taken_move.from_square, taken_move.to_square))]
+
+    if capture_square is not None:
+        clauses.append(holds_opponent(capture_square))
+    else:
+        clauses.append(lacks_opponent(taken_move.to_square))
+
+        # A pawn push cut short was blocked by an opponent piece on the next square
+        if taken_move.to_square != requested_move.to_square and moved_piece == chess.PAWN:
+            clauses.append(holds_opponent(requested_move.to_square))
+
+    return clauses
+
+def filter_move_result(states, clauses: list[list[tuple[chess.Square, list[int]]]]):
+    """
+        Removes the states that break clauses (see move_result_clauses) in one vectorised pass, returns (states, number removed)
+    """
+    if len(clauses) == 0 or len(states) == 0:
+        return states, 0
+
+    if isinstance(states, ParticleBelief):
+        parents = list(states.weights)
+        consistent = satisfying(state_codes(parents), clauses)
+        return states.subset(itertools.compress(parents, consistent)), len(parents) - int(np.count_nonzero(consistent))
+
+    return states, states.keep(satisfying(states.codes, clauses))
+
 # Update all states by a move
-def apply_move(states: set[str], move: chess.Move, turn: chess.Color):
+def apply_move(states: Belief, move: chess.Move, turn: chess.Color):
     """
         IMPORTANT ASSUMPTION: The move supplied is an applicable move
         i.e. If a state says the move is invalid, then the state must be invalid
+
+        Works on the piece codes of the states rather than pushing the move state by state: the successors' codes
+        follow from the parents' by moving a few columns (moved_codes), and their bitboards from the codes
+    """
+    # A state without a piece on the from square cannot play the move (board.push would assert)
+    valid = states.codes[:, move.from_square] != 0
+    num_removed = len(states) - int(np.count_nonzero(valid))
+
+    codes = moved_codes(states.codes[valid], move)
+
+    # Successor -> row of the first state that led to it (states differing only in what I captured collapse)
+    next_states = {}
+    for row, state in enumerate(code_states(codes)):
+        next_states.setdefault(state, row)
+
+    rows = np.fromiter(next_states.values(), dtype=np.intp, count=len(next_states))
+    next_codes = codes[rows]
+
+    # Carry the counts over: the dropped states come off and only the squares the move changes are counted again
+    kept = np.zeros(len(states), dtype=bool)
+    kept[np.flatnonzero(valid)[rows]] = True
+    next_counts = recount_squares(kept_counts(states.counts, states.codes, kept), next_codes, moved_squares(move))
+
+    return (Belief(next_states, next_codes, next_counts), num_removed)
+
+
+# generate_moves restricted to the moves that touch square
+def generate_moves_touching(board: chess.Board, square: chess.Square):
+    mask = chess.BB_SQUARES[square]
+    moves = list(board.generate_pseudo_legal_moves(from_mask=mask))
+    moves.extend(board.generate_pseudo_legal_moves(to_mask=mask))
+
+    # Castling touches the rook squares too, there are few enough candidates to leave them to the caller
+    if mask & chess.BB_BACKRANKS:
+        moves.extend(board.generate_castling_moves())
+        for m in rcu.without_opponent_pieces(board).generate_castling_moves():
+            if not rcu.is_illegal_castle(board, m):
+                moves.append(m)
+
+    for m in rcu.pawn_capture_moves_on(board):
+        if m.from_square == square or m.to_square == square:
+            moves.append(m)
+
+    return moves
+
+# Squares a move changes on board
+def touched_squares(board: chess.Board, move: chess.Move) -> int:
+    touched = chess.BB_SQUARES[move.from_square] | chess.BB_SQUARES[move.to_square]
+    if board.kings & chess.BB_SQUARES[move.from_square] and abs(move.to_square - move.from_square) == 2:
+        kingside = move.to_square > move.from_square
+        touched |= chess.BB_SQUARES[move.to_square + 1 if kingside else move.to_square - 2]
+        touched |= chess.BB_SQUARES[move.to_square - 1 if kingside else move.to_square + 1]
+
+    return touched
+
+
+# Number of states expanded between checks of the clock
+DEADLINE_CHECK_INTERVAL = 256
+
+# generate_moves restricted to the moves landing on square, read off the attack tables rather than filtered out of every move
+def generate_moves_onto(board: chess.Board, square: chess.Square):
+    mask = chess.BB_SQUARES[square]
+    moves = list(board.generate_pseudo_legal_moves(to_mask=mask))
+
+    if not board.occupied_co[board.turn] & mask:
+        for pawn_square in chess.scan_forward(board.attackers_mask(board.turn, square) & board.pawns):
+            moves.append(chess.Move(pawn_square, square))
+            if mask & chess.BB_BACKRANKS:
+                for piece_type in chess.PIECE_TYPES[1:-1]:
+                    moves.append(chess.Move(pawn_square, square, promotion=piece_type))
+
+    # The pseudo-legal moves already hold the pawn captures onto a piece (all but the unpromoted one on a back rank)
+    return list(dict.fromkeys(moves))
+
+# generate_moves without the moves that would capture a piece of the side not to move
+def generate_quiet_moves(board: chess.Board):
+    not_captures = chess.BB_ALL & ~board.occupied_co[not board.turn]
+    moves = [chess.Move.null()]
+    moves.extend(board.generate_pseudo_legal_moves(to_mask=not_captures))
+
+    for m in rcu.without_opponent_pieces(board).generate_castling_moves():
+        if not rcu.is_illegal_castle(board, m):
+            moves.append(m)
+
+    for m in rcu.pawn_capture_moves_on(board):
+        if chess.BB_SQUARES[m.to_square] & not_captures:
+            moves.append(m)
+
+    # Castling comes out of both the pseudo-legal moves and the castling moves of the board without opponent pieces
+    return list(dict.fromkeys(moves))
+
+# Moves the opponent could have made in board given where (if anywhere) they captured, each listed once, and how many
+# were ruled out (moves are generated to fit the capture, so the ones it rules out are never enumerated and count as 0)
+def opponent_moves(board: chess.Board, capture_square: chess.Square | None) -> tuple[list[chess.Move], int]:
+    if capture_square is None:
+        # Nothing of mine was taken, so the opponent cannot have moved onto any of my pieces
+        return generate_quiet_moves(board), 0
+
+    return generate_moves_onto(board, capture_square), 0
+
+def iter_successors(states, turn: chess.Color, capture_square: chess.Square | None, deadline: float | None = None, counts: dict[str, int] | None = None):
+    """
+        Lazily yields every state the opponent could have moved to from states (successors may repeat)
+
+        deadline -> time.time() after which the remaining states are not expanded
+            Without a capture they are yielded as they are (the opponent passing), with a capture they are dropped
+        counts -> if given, counts["ignored"] is increased by the number of moves ruled out by the capture
+    """
+    board = chess.Board()
+    board.turn = turn
+
+    remaining_states = iter(states)
+    for i, state in enumerate(remaining_states):
+        if deadline is not None and i % DEADLINE_CHECK_INTERVAL == 0 and time.time() > deadline:
+            if capture_square is None:
+                yield state
+                yield from remaining_states
+            return
+
+        set_board_state(board, state)
+        moves, num_ignored = opponent_moves(board, capture_square)
+        if counts is not None:
+            counts["ignored"] = counts.get("ignored", 0) + num_ignored
+
+        for m in moves:
+            board.push(m)
+            successor = board_state(board)
+            board.pop()
+            yield successor
+
+def iter_unique_successors(states, turn: chess.Color, capture_square: chess.Square | None, deadline: float | None = None, counts: dict[str, int] | None = None, max_keys: int | None = None):
     """
+        iter_successors without repeats, deduplicated on Zobrist keys before anything is pushed
+        A successor's key is its parent's key XOR move_key, so a successor reached again is skipped for a few
+        piece lookups instead of a push, a new state and a pop
+
+        max_keys -> if given, at most this many keys are remembered, later successors are yielded without being
+            remembered (so they may repeat) and memory stays bounded however many successors there are
+    """
+    parents = list(states)
+    parent_codes = states.codes if isinstance(states, Belief) else state_codes(parents)
+    parent_keys = state_keys(parent_codes).tolist()
+    seen = set()
+    max_keys = max_keys if max_keys is not None else float("inf")
+
+    board = chess.Board()
+    board.turn = turn
+
+    for i, (key, state) in enumerate(zip(parent_keys, parents)):
+        if deadline is not None and i % DEADLINE_CHECK_INTERVAL == 0 and time.time() > deadline:
+            if capture_square is None:
+                for key, state in zip(parent_keys[i:], parents[i:]):
+                    if key not in seen:
+                        if len(seen) < max_keys:
+                            seen.add(key)
+                        yield state
+            return
+
+        set_board_state(board, state)
+        moves, num_ignored = opponent_moves(board, capture_square)
+        if counts is not None:
+            counts["ignored"] = counts.get("ignored", 0) + num_ignored
+
+        codes = parent_codes[i].tolist()
+        for m in moves:
+            successor_key = key ^ move_key(codes, m)
+            if successor_key in seen:
+                continue
+
+            if len(seen) < max_keys:
+                seen.add(successor_key)
+            board.push(m)
+            successor = board_state(board)
+            board.pop()
+            yield successor
+
+def unique(items):
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
+def reservoir_sample(items, size: int) -> set:
+    """
+        Sample (algorithm R) of at most size distinct items from a stream, holding only the sample in memory
+        Only items already in the reservoir are skipped, every other repeat counts as a fresh draw, so the sample
+        is uniform over the stream rather than over its distinct items: a successor reachable through several
+        opponent moves is proportionally more likely to be kept
+    """
+    reservoir = []
+    positions = {}
+    num_seen = 0
+
+    for item in items:
+        if item in positions:
+            continue
+
+        num_seen += 1
+        if len(reservoir) < size:
+            positions[item] = len(reservoir)
+            reservoir.append(item)
+            continue
+
+        j = random.randrange(num_seen)
+        if j < size:
+            del positions[reservoir[j]]
+            positions[item] = j
+            reservoir[j] = item
+
+    return set(reservoir)
+
+# Update all states by all possible moves for that state
+def expand_states(states, turn: chess.Color, capture_square: chess.Square | None, deadline: float | None = None, cap: int | None = None, reservoir: bool = True, zobrist: bool = False) -> tuple[set[State], int]:
+    """
+        Streams the successors of states through deduplication, without materialising more than cap of them
+            cap None -> keep every successor
+            reservoir -> keep a uniform sample of cap successors, otherwise keep the first cap
+            zobrist -> drop repeated successors on their Zobrist keys before they are built (iter_unique_successors),
+                remembering at most cap keys so memory stays bounded by cap
+    """
+    counts = {"ignored": 0}
+    if zobrist:
+        successors = iter_unique_successors(states, turn, capture_square, deadline, counts, cap)
+    else:
+        successors = iter_successors(states, turn, capture_square, deadline, counts)
+
+    if cap is None:
+        new_states = set(successors)
+    elif reservoir:
+        new_states = reservoir_sample(successors, cap)
+    else:
+        new_states = set(itertools.islice(unique(successors), cap))
+
+    return new_states, counts["ignored"]
+
+def evolve_states(states: Belief, turn: chess.Color, capture_square: chess.Square | None, deadline: float | None = None, cap: int | None = None, zobrist: bool = False):
+    new_states, ignored_states = expand_states(states, turn, capture_square, deadline, cap, zobrist=zobrist)
+    return Belief(new_states), ignored_states
+
+def sense_first_evolve_states(states, turn: chess.Color, capture_square: chess.Square | None, sense_result: list[tuple[chess.Square, chess.Piece | None]], deadline: float | None = None) -> tuple[Belief, int]:
+    """
+        evolve_states run after the sense, generating only the successors that agree with sense_result
+
+        A move leaves every square it does not touch as it was, so a parent that disagrees with the sense on some
+        squares can only lead to a match through moves touching all of them: those are generated from or to one
+        mismatched square and pushed only if they cover the rest. A parent that already agrees keeps its null move.
+        With a deadline, unexpanded states are kept as they are if they agree with the sense and there was no capture
+    """
+    pattern = sense_pattern(sense_result)
+
     board = chess.Board()
     board.turn = turn
 
     next_states = set()
+    ignored_states = 0
+
+    remaining_states = iter(states)
+    for i, state in enumerate(remaining_states):
+        if deadline is not None and i % DEADLINE_CHECK_INTERVAL == 0 and time.time() > deadline:
+            if capture_square is None:
+                next_states.update(s for s in itertools.chain([state], remaining_states) if matches_pattern(s, pattern))
+            break
+
+        set_board_state(board, state)
+        mismatches = pattern_mismatches(state, pattern)
+
+        if capture_square is not None:
+            moves, num_ignored = opponent_moves(board, capture_square)
+            ignored_states += num_ignored
+        elif mismatches == chess.BB_EMPTY:
+            moves = generate_quiet_moves(board)
+        else:
+            # Nothing of mine was taken, so moves onto my pieces are out as in generate_quiet_moves
+            moves = [m for m in generate_moves_touching(board, chess.lsb(mismatches)) if not chess.BB_SQUARES[m.to_square] & board.occupied_co[not turn]]
+
+        for m in moves:
+            if mismatches & ~touched_squares(board, m):
+                continue
+
+            board.push(m)
+            successor = board_state(board)
+            board.pop()
+            if matches_pattern(successor, pattern):
+                next_states.add(successor)
+
+    return Belief(next_states), ignored_states
+
+def lazy_evolve_states(states, turn: chess.Color, capture_square: chess.Square | None, deadline: float | None = None) -> tuple[LazyBelief, int]:
+    """
+        evolve_states that only records which move was played from which state, see LazyBelief
+        With a deadline, unexpanded states are referenced with a null move (or dropped when there was a capture)
+    """
+    board = chess.Board()
+    board.turn = turn
+
+    parents = list(states)
+    parent_ids = array.array("i")
+    from_squares = array.array("b")
+    to_squares = array.array("b")
+    promotions = array.array("b")
+    ignored_states = 0
+
+    for parent_id, state in enumerate(parents):
+        if deadline is not None and parent_id % DEADLINE_CHECK_INTERVAL == 0 and time.time() > deadline:
+            if capture_square is None:
+                num_unexpanded = len(parents) - parent_id
+                parent_ids.extend(range(parent_id, len(parents)))
+                from_squares.extend([0] * num_unexpanded)
+                to_squares.extend([0] * num_unexpanded)
+                promotions.extend([0] * num_unexpanded)
+            break
+
+        set_board_state(board, state)
+        moves, num_ignored = opponent_moves(board, capture_square)
+        ignored_states += num_ignored
+
+        for m in moves:
+            parent_ids.append(parent_id)
+            from_squares.append(m.from_square)
+            to_squares.append(m.to_square)
+            promotions.append(piece_code(chess.Piece(m.promotion, turn)) if m.promotion else 0)
+
+    lazy_states = LazyBelief(parents, turn, np.frombuffer(parent_ids, dtype=np.int32), np.frombuffer(from_squares, dtype=np.int8), np.frombuffer(to_squares, dtype=np.int8), np.frombuffer(promotions, dtype=np.int8))
+    return lazy_states, ignored_states
+
+def evolve_particles(particles: ParticleBelief, turn: chess.Color, capture_square: chess.Square | None, deadline: float | None = None) -> tuple[ParticleBelief, int]:
+    """
+        evolve_states for a weighted belief, each state's weight is split evenly over the opponent moves it allows
+        and successors reached from several states add up their weights
+        (opponent_moves lists every move once, a repeated pawn capture or castle would take a double share)
+    """
+    board = chess.Board()
+    board.turn = turn
+
+    new_weights = {}
+    ignored_states = 0
+
+    remaining_particles = iter(particles.weights.items())
+    for i, (state, weight) in enumerate(remaining_particles):
+        if deadline is not None and i % DEADLINE_CHECK_INTERVAL == 0 and time.time() > deadline:
+            if capture_square is None:
+                for state, weight in itertools.chain([(state, weight)], remaining_particles):
+                    new_weights[state] = new_weights.get(state, 0.0) + weight
+            break
+
+        set_board_state(board, state)
+        moves, num_ignored = opponent_moves(board, capture_square)
+        ignored_states += num_ignored
+
+        for m in moves:
+            board.push(m)
+            successor = board_state(board)
+            new_weights[successor] = new_weights.get(successor, 0.0) + weight / len(moves)
+            board.pop()
 
+    return ParticleBelief(new_weights), ignored_states
+
+def apply_move_particles(particles: ParticleBelief, move: chess.Move, turn: chess.Color) -> tuple[ParticleBelief, int]:
+    """
+        apply_move for a weighted belief, weights follow their states
+    """
+    board = chess.Board()
+    board.turn = turn
+
+    next_weights = {}
     num_removed = 0
 
-    for state in states:
-        board.set_board_fen(state)
+    for state, weight in particles.weights.items():
+        set_board_state(board, state)
 
         try:
             board.push(move)
-            next_states.add(board.board_fen())
+            successor = board_state(board)
+            next_weights[successor] = next_weights.get(successor, 0.0) + weight
             board.pop()
         except AssertionError:
-            # Attempted move invalid => state is invalid => remove state
             num_removed += 1
 
-    return (next_states, num_removed)
+    return ParticleBelief(next_weights), num_removed
 
 
-# Update all states by all possible moves for that state
-def evolve_states(states: set[str], turn: chess.Color, capture_square: chess.Square | None):
-    board = chess.Board()
-    board.turn = turn
+# Below this many states a shard is not worth the pickling round trip to a worker
+MIN_SHARD_SIZE = 2_000
+
+def default_workers() -> int:
+    """
+        One worker per core available to this process, leaving a core for the main process and stockfish
+    """
+    if hasattr(os, "sched_getaffinity"):
+        num_cores = len(os.sched_getaffinity(0))
+    else:
+        num_cores = os.cpu_count() or 1
+
+    return max(1, num_cores - 1)
+
+def create_expansion_pool(num_workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    """
+        Forks the workers straight away where possible, so they are started before this agent's engine thread and
+        scripts without a __main__ guard (onevone.py) are not re-imported the way spawn would
+    """
+    method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context(method))
+    pool.submit(int).result()
+
+    return pool
+
+def evolve_states_parallel(states: Belief, turn: chess.Color, capture_square: chess.Square | None, pool: concurrent.futures.ProcessPoolExecutor, num_workers: int, deadline: float | None = None, cap: int | None = None, zobrist: bool = False):
+    """
+        evolve_states with the states sharded across a process pool, each worker returns its deduplicated successors
+        (a reservoir sample of an even share of cap when capped)
+        Falls back to a single core when the belief is too small to split
+    """
+    num_shards = min(num_workers, len(states) // MIN_SHARD_SIZE)
+    if num_shards <= 1:
+        return evolve_states(states, turn, capture_square, deadline, cap, zobrist)
+
+    states = list(states)
+    shard_size = -(-len(states) // num_shards)
+    shards = [states[i:i + shard_size] for i in range(0, len(states), shard_size)]
+
+    shard_cap = -(-cap // len(shards)) if cap is not None else None
 
     new_states = set()
     ignored_states = 0
+    for shard_states, shard_ignored in pool.map(expand_states, shards, itertools.repeat(turn), itertools.repeat(capture_square), itertools.repeat(deadline), itertools.repeat(shard_cap), itertools.repeat(True), itertools.repeat(zobrist)):
+        new_states.update(shard_states)
+        ignored_states += shard_ignored
 
-    for state in states:
-        board.set_board_fen(state)
-        moves = generate_moves(board)
+    return Belief(new_states), ignored_states
 
-        for m in moves:
-            if capture_square is not None and m.to_square == capture_square:
-                board.push(m)
-                new_states.add(board.board_fen())
-                board.pop()
-            elif capture_square is not None and m.to_square != capture_square:
-                ignored_states += 1
-            elif capture_square is None:
-                board.push(m)
-                new_states.add(board.board_fen())
-                board.pop()
-
-    return new_states, ignored_states
+# Boards handed to the engines between checks of the running tally, per engine
+VOTE_BATCH_ENGINE_MULTIPLE = 2
+
+# Votes needed before the confidence threshold may stop the search
+MIN_VOTES = 20
+
+def anytime_vote(boards: list[chess.Board], play_batch, batch_size: int, valid_moves: set[str], confidence: float | None, weights: list[float] | None = None) -> dict[str, float]:
+    """
+        Plays boards in order, batch_size at a time, keeping a running tally of the chosen moves (uci -> votes)
+        Each board votes with its weight in weights, or 1 without weights
+
+        Stops before the end once the leading valid move cannot be overtaken by the boards still to play, or
+        once it holds at least confidence of the valid votes after MIN_VOTES boards voted for a valid move
+        (confidence None disables this)
+    """
+    weights = weights if weights is not None else [1] * len(boards)
+    remaining = sum(weights)
+
+    selected_moves = {}
+    num_valid_votes = 0
+    for start in range(0, len(boards), batch_size):
+        batch_weights = weights[start:start + batch_size]
+        for result, weight in zip(play_batch(boards[start:start + batch_size]), batch_weights):
+            if result is None:
+                continue
+
+            move_uci = result.move.uci() if result.move is not None else '0000'
+            if move_uci not in selected_moves.keys():
+                selected_moves[move_uci] = weight
+            else:
+                selected_moves[move_uci] += weight
+            if move_uci in valid_moves:
+                num_valid_votes += 1
+
+        remaining -= sum(batch_weights)
+        valid_votes = sorted((votes for move_uci, votes in selected_moves.items() if move_uci in valid_moves), reverse=True)
+        if start + batch_size >= len(boards) or len(valid_votes) == 0:
+            continue
+
+        leader = valid_votes[0]
+        runner_up = valid_votes[1] if len(valid_votes) > 1 else 0
+        if leader - runner_up > remaining:
+            break
+
+        if confidence is not None and num_valid_votes >= MIN_VOTES and leader / sum(valid_votes) >= confidence:
+            break
+
+    return selected_moves
 
 class ImprovedAgent(rc.Player):
-    def __init__(self):
+    def __init__(self, array_belief: bool = False, expansion_workers: int | None = 0, engine_pool_size: int = 0, engine_cache_size: int = 100_000, vote_confidence: float | None = None, particle_budget: int = 0, expansion_cap: int = 0, lazy_expansion: bool = False, sense_first_expansion: bool = False, information_gain_sensing: bool = False, zobrist_dedup: bool = False, snapshot_dir: str | None = None, instrument_dir: str | None = None):
         self.colour = False
         self.my_board = None
         self.current_move = 0
-        self.states = set()
+        self.states = Belief()
+
+        # Filter observations with ArrayBelief masks
+        self.array_belief = array_belief
+
+        # Number of processes to expand opponent moves over, None sizes the pool to the machine (default_workers)
+        # 0 or 1 keeps expansion on this process
+        self.expansion_workers = default_workers() if expansion_workers is None else expansion_workers
+        self.expansion_pool = None
+
+        # Size of the choose_move EnginePool, 0 for none
+        self.engine_pool_size = engine_pool_size
+        self.engine_pool = None
+
+        # Entries in the per game EngineCache, 0 for none
+        self.engine_cache_size = engine_cache_size
+        self.engine_cache = None
+
+        self.time_manager = TimeManager()
+
+        # choose_move searches states in priority order and stops once this share of the votes agree
+        # (None searches the selected states in the order they were selected, or most likely first when weighted)
+        self.vote_confidence = vote_confidence
+
+        # Track a weighted belief resampled down to this many states after every expansion (0 keeps every state)
+        self.particle_budget = particle_budget
+
+        # Reservoir sample at most this many successors while expanding opponent moves (0 keeps every successor)
+        self.expansion_cap = expansion_cap
+
+        # Keep opponent moves as (state, move) references until the sense result says which successors to build
+        self.lazy_expansion = lazy_expansion
+
+        # Hold off expanding opponent moves until the sense result is known and only generate successors agreeing
+        # with it. The opponent's capture square is kept here in the meantime, choose_sense looks at the parents
+        self.sense_first_expansion = sense_first_expansion
+        self.pending_expansion = False
+        self.pending_capture_square = None
+
+        # Sense where the joint contents of the window split the states best, rather than where the
+        # summed per square entropies are highest (which ignores how the squares depend on each other)
+        self.information_gain_sensing = information_gain_sensing
+
+        # Deduplicate opponent successors on Zobrist keys before pushing them rather than after
+        self.zobrist_dedup = zobrist_dedup
+
+        # Dump a belief snapshot into this directory on entry to every turn callback (see improved/snapshot.py)
+        self.snapshot_dir = snapshot_dir
+
+        # Record callback and stage timings with belief sizes, written to this directory as JSON at the end of the game
+        self.instrument_dir = instrument_dir
+        self.instrument = Instrument(type(self).__qualname__) if instrument_dir is not None else None
+
         self.logger = logging.getLogger('entropic.opening')
         logging.basicConfig(filename="improved-4.log", encoding="utf-8", level=logging.DEBUG)
 
@@ -185,6 +794,7 @@ class ImprovedAgent(rc.Player):
         }
 
     # ReconChess Player Requirements
+    @instrumented
     def handle_game_start(self, color: chess.Color, board: chess.Board, opponent_name: str):
         self.colour = color
         self.my_colour = "White" if color else "Black"
@@ -194,15 +804,65 @@ class ImprovedAgent(rc.Player):
         board.turn = self.colour
 
         self.my_board = rcu.without_opponent_pieces(board)
-        self.engine = chess.engine.SimpleEngine.popen_uci(stockfish_path, setpgrp=True)
+        if self.expansion_workers > 1:
+            self.expansion_pool = create_expansion_pool(self.expansion_workers)
+        self.engine_cache = EngineCache(self.engine_cache_size) if self.engine_cache_size > 0 else None
+        with stage(self.instrument, "engine_spawn"):
+            self.engine = chess.engine.SimpleEngine.popen_uci(stockfish_path, setpgrp=True)
+            if self.engine_cache is not None:
+                self.engine = CachedEngine(self.engine, self.engine_cache)
+            if self.engine_pool_size > 0:
+                self.engine_pool = EnginePool(stockfish_path, self.engine_pool_size, cache=self.engine_cache, setpgrp=True)
+
+        if self.instrument is not None:
+            self.instrument.colour = self.my_colour
 
         self.sets = set()
-        self.states.add(board.board_fen())
+        # Drawn from random so seeding random (as replay.py does) also fixes the particle resampling
+        self.rng = np.random.default_rng(random.getrandbits(64))
+        if self.particle_budget > 0:
+            self.states = ParticleBelief.uniform([board_state(board)])
+        else:
+            self.states = Belief([board_state(board)])
 
         self.current_move = 0
 
+    def dump_snapshot(self, path: str, callback: str = "", **arguments):
+        save_snapshot(path, self.states, {
+            "agent": type(self).__qualname__,
+            "callback": callback,
+            "colour": self.colour,
+            "current_move": self.current_move,
+            "my_board": self.my_board.fen(),
+            "perform_opening": self.perform_opening,
+            "pending_expansion": self.pending_expansion,
+            "pending_capture_square": self.pending_capture_square,
+            "seconds_left": self.time_manager.seconds_left(),
+            "arguments": encode_arguments(arguments),
+        })
+
+    def restore_snapshot(self, snapshot: Snapshot):
+        """
+            Puts the agent back in the position a snapshot was taken in, after handle_game_start
+        """
+        metadata = snapshot.metadata
+        self.states = snapshot.belief()
+        self.my_board = chess.Board(metadata["my_board"])
+        self.current_move = metadata["current_move"]
+        self.perform_opening = metadata["perform_opening"]
+        self.pending_expansion = metadata["pending_expansion"]
+        self.pending_capture_square = metadata["pending_capture_square"]
+        self.time_manager.clock = metadata["seconds_left"]
+
+    def auto_snapshot(self, callback: str, **arguments):
+        if self.snapshot_dir is not None:
+            self.dump_snapshot(os.path.join(self.snapshot_dir, f"{self.my_colour.lower()}-{self.current_move:03d}-{callback}.snap"), callback, **arguments)
+
+    @instrumented
     def handle_opponent_move_result(self, captured_my_piece: bool, capture_square: int | None):
+        self.auto_snapshot("handle_opponent_move_result", captured_my_piece=captured_my_piece, capture_square=capture_square)
         self.current_move += 1
+        self.time_manager.start_turn(self.current_move)
         # print('--------------------------------')
         # print(f'Move {self.current_move}')
         # print(f'{self.my_colour} in {self.my_board.board_fen()}')
@@ -211,87 +871,158 @@ class ImprovedAgent(rc.Player):
         if self.colour == chess.WHITE and self.current_move == 1:
             return
 
+        if self.sense_first_expansion and not isinstance(self.states, ParticleBelief):
+            self.pending_expansion = True
+            self.pending_capture_square = capture_square
+            return
+
         # Generate opponents possible moves
-        self.states, num_removed_states = evolve_states(self.states, not self.colour, capture_square)
+        deadline = self.time_manager.deadline(EXPAND)
+        with stage(self.instrument, "expand"):
+            if isinstance(self.states, ParticleBelief):
+                self.states, num_removed_states = evolve_particles(self.states, not self.colour, capture_square, deadline)
+                self.states.resample(self.particle_budget, self.rng)
+            elif self.lazy_expansion:
+                self.states, num_removed_states = lazy_evolve_states(self.states, not self.colour, capture_square, deadline)
+            elif self.expansion_pool is not None:
+                self.states, num_removed_states = evolve_states_parallel(self.states, not self.colour, capture_square, self.expansion_pool, self.expansion_workers, deadline, self.expansion_cap or None, self.zobrist_dedup)
+            else:
+                self.states, num_removed_states = evolve_states(self.states, not self.colour, capture_square, deadline, self.expansion_cap or None, self.zobrist_dedup)
 
         # print(f'Opp move result:\tremoved {num_removed_states}')
 
+    @instrumented
     def choose_sense(self, sense_actions: list[chess.Square], move_actions: list[chess.Move], seconds_left: float) -> chess.Square | None:
         # print(f'{self.my_colour} time left:\t{seconds_left} seconds')
-
-        probabilites = calculate_probabilites(self.states)
-        entropy = calculate_entropy(probabilites) if probabilites is not None else np.zeros((8,8))
+        self.time_manager.observe_clock(seconds_left)
+        self.auto_snapshot("choose_sense", sense_actions=sense_actions, move_actions=move_actions, seconds_left=seconds_left)
+
+        with stage(self.instrument, "sense_scoring"):
+            entropy = None
+            if self.information_gain_sensing:
+                # Falls back to the summed square entropies if the windows cannot all be scored in the sense budget
+                entropy = sense_information_gain(*belief_codes(self.states), deadline=self.time_manager.deadline(SENSE))
+            if entropy is None:
+                probabilites = self.states.probabilities()
+                entropy = calculate_entropy(probabilites) if probabilites is not None else np.zeros((8,8))
 
         # Remove the squares around the edges of the board (remove rank 1 & 8, remove file a & h)
         entropy = np.reshape(entropy[1:7, 1:7], (6*6)) # removing ranks 1 & 8
 
         sense_actions = np.reshape(np.reshape(np.array(sense_actions), (8,8))[1:7, 1:7], (6*6))
-        max_indices = np.argwhere(entropy == np.amax(entropy))
+        max_indices = np.flatnonzero(entropy == np.amax(entropy))
 
         selected_sense_square = sense_actions[random.choice(max_indices)]
 
         # print(f'Sense choice:\t{chess.square_name(selected_sense_square)} with entropy {np.reshape(entropy, (6*6))[selected_indices]} | max entropy {np.max(entropy)}')
         return int(selected_sense_square)
 
+    @instrumented
     def handle_sense_result(self, sense_result: rc.List[rc.Tuple[chess.Square | chess.Piece | None]]):
+        self.auto_snapshot("handle_sense_result", sense_result=sense_result)
         # before_state_size = len(self.states)
-        removed_states = set()
+        if self.pending_expansion:
+            self.pending_expansion = False
+            with stage(self.instrument, "expand"):
+                self.states, num_removed_states = sense_first_evolve_states(self.states, not self.colour, self.pending_capture_square, sense_result, self.time_manager.deadline(EXPAND))
+            return
 
-        board = chess.Board()
-        for state in self.states:
-            board.set_board_fen(state)
-            for sense_square in sense_result:
-                if board.piece_at(sense_square[0]) != sense_square[1]:
-                    removed_states.add(state)
-                    break
+        with stage(self.instrument, "sense_filter"):
+            if isinstance(self.states, LazyBelief):
+                self.states.filter_sense(sense_result)
+                self.states = Belief(self.states.materialise())
+                return
+
+            if self.array_belief:
+                if isinstance(self.states, ParticleBelief):
+                    belief = ArrayBelief.from_states(self.states)
+                    belief.filter_sense(sense_result)
+                    self.states = self.states.subset(belief.states)
+                else:
+                    # A Belief already holds the code array, the sense is one mask over its columns
+                    self.states.filter_sense(sense_result)
+                return
 
-        for removed_state in removed_states:
-            self.states.remove(removed_state)
+            pattern = sense_pattern(sense_result)
+            if isinstance(self.states, ParticleBelief):
+                self.states.difference_update([state for state in self.states if not matches_pattern(state, pattern)])
+            else:
+                self.states.keep([matches_pattern(state, pattern) for state in self.states])
 
         # print(f'Sense result:\t\tremoved {len(removed_states)} of {before_state_size} | {len(removed_states) / before_state_size if before_state_size != 0 else 1e6 * 100:.2f}%')
 
+    @instrumented
     def choose_move(self, move_actions: list[chess.Move], seconds_left: float) -> chess.Move | None:
+        self.time_manager.observe_clock(seconds_left)
+        self.auto_snapshot("choose_move", move_actions=move_actions, seconds_left=seconds_left)
+        move_deadline = self.time_manager.deadline(MOVE)
+
         # Score range of state evaluation is in centipawns
-        search_states = select_best_states(self.states, not self.colour, self.engine, [33_333, 33_334, 33_333], [-400, -200, 200, 400])
+        # State selection may use up to half of the move budget, the searches get whatever is left
+        selection_deadline = time.time() + (move_deadline - time.time()) / 2
+        buckets = {}
+        with stage(self.instrument, "select_states"):
+            search_states = select_best_states(self.states, not self.colour, self.engine, [33_333, 33_334, 33_333], [-400, -200, 200, 400], selection_deadline, buckets)
         board = chess.Board()
-        for state in search_states:
-            board.set_board_fen(state)
-            board.clear_stack()
-            board.turn = self.colour
-
-            opposing_king_square = board.king(not self.colour)
-            possible_moves = generate_moves(board)
-            for move in possible_moves:
-                if opposing_king_square == move.to_square and move in move_actions:
-                    return move
+        with stage(self.instrument, "king_scan"):
+            # Take the king in as many of the states as possible
+            if isinstance(self.states, Belief) and search_states == self.states.states:
+                # select_best_states kept every state, in order, so the stored codes line up
+                search_codes = self.states.codes
+            else:
+                search_codes = state_codes(search_states)
+            king_captures = king_capture_moves(search_codes, self.colour, move_actions)
+            if len(king_captures) != 0:
+                return max(king_captures, key=king_captures.get)
 
         # If in the opening stages of the game, play a specific move sequence to try capture the opponents king
+        # Once it runs out, this turn goes straight on to the search with the clock and states it already has
+        if self.perform_opening and self.current_move >= len(self.opening_moves[self.colour]):
+            self.perform_opening = False
+
         if self.perform_opening:
-            if self.current_move >= len(self.opening_moves[self.colour]):
-                self.perform_opening = False
-                return self.choose_move(move_actions, seconds_left)
-            else:
-                selected_move = self.opening_moves[self.colour][self.current_move - 1]
-                return selected_move
+            selected_move = self.opening_moves[self.colour][self.current_move - 1]
+            return selected_move
         else:
             # pick opponents best states for a bit of the minimax action lmao
 
             # print(f'Stockfish search:\t{len(search_states)} states at {10 / len(search_states) if len(search_states) != 0 else 1e6} seconds per state')
-            selected_moves = {}
+            if self.engine_pool is not None:
+                parallelism = len(self.engine_pool)
+            else:
+                parallelism = 1
+            search_time, num_searched = self.time_manager.per_state_time(move_deadline - time.time(), len(search_states), MIN_SEARCH_TIME, parallelism)
+            limit = chess.engine.Limit(time=search_time)
+
+            # A weighted belief is always searched most likely state first, so when only num_searched states fit in the
+            # budget the heaviest particles are the ones kept. With early stopping, an unweighted belief is searched
+            # best for the opponent first (the bucket select_best_states picked them for)
+            # priority_order shuffles them first, so ties, and every state when select_best_states kept them all
+            # without bucketing them, come in random order and the tally is never settled on a prefix in expansion order
+            search_states = list(search_states)
+            if isinstance(self.states, ParticleBelief):
+                search_states = priority_order(search_states, self.states.weights)
+            elif self.vote_confidence is not None:
+                search_states = priority_order(search_states, buckets)
+            search_states = search_states[:num_searched]
+
+            search_boards = []
+            board.turn = self.colour
+            for state in search_states:
+                set_board_state(board, state)
+                search_boards.append(board.copy(stack=False))
 
-            try:
-                result = self.engine.play(board, chess.engine.Limit(time=10 / len(search_states) if len(search_states) != 0 else 1e6))
+            # Particles vote with their weight (resampling leaves a state drawn several times heavier than the rest)
+            search_weights = [self.states.weights[state] for state in search_states] if isinstance(self.states, ParticleBelief) else None
 
-                move_uci = result.move.uci() if result.move is not None else '0000'
-                if move_uci not in selected_moves.keys():
-                    selected_moves[move_uci] = 1
-                else:
-                    selected_moves[move_uci] += 1
+            if self.engine_pool is not None:
+                play_batch = lambda boards: self.engine_pool.play_many(boards, limit)
+            else:
+                play_batch = lambda boards: [self.play_board(board, limit) for board in boards]
 
-            except chess.engine.EngineTerminatedError:
-                print(f"Engine died: state {state}")
-            except chess.engine.EngineError:
-                print(f'Engine bad state {state}')
+            valid_moves = set(move.uci() for move in move_actions)
+            with stage(self.instrument, "engine_search"):
+                selected_moves = anytime_vote(search_boards, play_batch, parallelism * VOTE_BATCH_ENGINE_MULTIPLE, valid_moves, self.vote_confidence, search_weights)
 
             nonexisting_moves = 0
             if len(selected_moves) != 0:
@@ -312,7 +1043,19 @@ class ImprovedAgent(rc.Player):
             else:
                 return None
 
+    def play_board(self, board: chess.Board, limit: chess.engine.Limit) -> chess.engine.PlayResult | None:
+        try:
+            return self.engine.play(board, limit)
+        except chess.engine.EngineTerminatedError:
+            print(f"Engine died: state {board.board_fen()}")
+        except chess.engine.EngineError:
+            print(f'Engine bad state {board.board_fen()}')
+
+        return None
+
+    @instrumented
     def handle_move_result(self, requested_move: chess.Move | None, taken_move: chess.Move | None, captured_opponent_piece: chess.Color, capture_square: chess.Square | None):
+        self.auto_snapshot("handle_move_result", requested_move=requested_move, taken_move=taken_move, captured_opponent_piece=captured_opponent_piece, capture_square=capture_square)
 
         # print(f'Move choice:\t\t{requested_move.uci() if requested_move else "0000"}')
         # print(f'Move taken:\t\t{taken_move.uci() if taken_move else "0000"}')
@@ -321,18 +1064,46 @@ class ImprovedAgent(rc.Player):
         num_invalid_move_for_state_removed = 0
         num_invalid_move_taken_removed = 0
 
+        if requested_move:
+            with stage(self.instrument, "move_result_filter"):
+                clauses = move_result_clauses(self.colour, self.my_board.piece_type_at(requested_move.from_square), requested_move, taken_move, capture_square)
+                self.states, num_invalid_move_taken_removed = filter_move_result(self.states, clauses)
+
         if taken_move:
             self.my_board.turn = self.colour
             self.my_board.set_piece_at(taken_move.to_square, self.my_board.piece_at(taken_move.from_square), False)
             self.my_board.remove_piece_at(taken_move.from_square)
-            self.states, num_invalid_move_for_state_removed = apply_move(self.states, taken_move, self.colour)
+            with stage(self.instrument, "apply_move"):
+                if isinstance(self.states, ParticleBelief):
+                    self.states, num_invalid_move_for_state_removed = apply_move_particles(self.states, taken_move, self.colour)
+                else:
+                    self.states, num_invalid_move_for_state_removed = apply_move(self.states, taken_move, self.colour)
             # Invalid moves are pruned within apply_move
 
+        self.time_manager.end_turn()
+
         # print(f'My move result:\t\tremoved {num_invalid_move_for_state_removed + num_invalid_move_taken_removed} of {before_state_size} | {(num_invalid_move_for_state_removed + num_invalid_move_taken_removed) / before_state_size if before_state_size != 0 else 1e6 * 100:.2f}%')
 
 
+    @instrumented
     def handle_game_end(self, winner_color: chess.Color | None, win_reason: rc.WinReason | None, game_history: rc.GameHistory):
         try:
             self.engine.quit()
         except chess.engine.EngineTerminatedError:
             self.logger.error("Failed to terminate engine")
+
+        if self.expansion_pool is not None:
+            self.expansion_pool.shutdown(cancel_futures=True)
+            self.expansion_pool = None
+
+        if self.engine_pool is not None:
+            self.engine_pool.quit()
+            self.engine_pool = None
+
+        if self.engine_cache is not None:
+            self.logger.debug(f'Engine cache:\t\t{self.engine_cache.stats()}')
+
+        if self.instrument is not None:
+            # Written once the record of this callback is in, a further game on this agent records into a fresh instrument
+            self.instrument.save_after(os.path.join(self.instrument_dir, f"{type(self).__qualname__}-{self.my_colour.lower()}-{int(time.time() * 1000)}.json"))
+            self.instrument = Instrument(type(self).__qualname__)
@@ -0,0 +1,630 @@
+import itertools
+import random
+import struct
+import time
+import chess
+import numpy as np
+
+# A belief state is the 12 piece bitboards of a board packed as little endian uint64s, in the order
+#   white pawn, knight, bishop, rook, queen, king, black pawn, knight, bishop, rook, queen, king
+# The 96 byte string takes about 129 B per state, around what a FEN string takes (100-120 B) and far below a
+# tuple of the 12 ints (about 465 B). It hashes quickly and loads straight back into a chess.Board without
+# parsing a FEN. FENs are only produced at the edges (logging, debugging). Belief keeps a 64 byte piece code
+# row per state on top of this.
+State = bytes
+
+NUM_PIECE_KINDS = 12
+STATE_FORMAT = struct.Struct("<12Q")
+
+
+def piece_index(piece: chess.Piece) -> int:
+    return piece.piece_type - 1 + (0 if piece.color == chess.WHITE else 6)
+
+
+def board_state(board: chess.BaseBoard) -> State:
+    white = board.occupied_co[chess.WHITE]
+    black = board.occupied_co[chess.BLACK]
+
+    return STATE_FORMAT.pack(
+        board.pawns & white, board.knights & white, board.bishops & white,
+        board.rooks & white, board.queens & white, board.kings & white,
+        board.pawns & black, board.knights & black, board.bishops & black,
+        board.rooks & black, board.queens & black, board.kings & black,
+    )
+
+
+def set_board_state(board: chess.BaseBoard, state: State):
+    """
+        Replaces the pieces of board with those of state, leaving turn, castling rights and the move stack alone
+        (the same things set_board_fen leaves alone apart from the stack)
+    """
+    wp, wn, wb, wr, wq, wk, bp, bn, bb, br, bq, bk = STATE_FORMAT.unpack(state)
+
+    board.pawns = wp | bp
+    board.knights = wn | bn
+    board.bishops = wb | bb
+    board.rooks = wr | br
+    board.queens = wq | bq
+    board.kings = wk | bk
+    board.promoted = chess.BB_EMPTY
+
+    white = wp | wn | wb | wr | wq | wk
+    black = bp | bn | bb | br | bq | bk
+    board.occupied_co[chess.WHITE] = white
+    board.occupied_co[chess.BLACK] = black
+    board.occupied = white | black
+
+
+# Zobrist keys: a random 64-bit number per (piece code, square), 0 for empty squares. The key of a state is the
+# XOR of the numbers of its pieces, so a move changes it by XORing out and in the few squares it touches
+_zobrist_random = random.Random(20230512)
+ZOBRIST = np.array([[0] * 64] + [[_zobrist_random.getrandbits(64) for _ in range(64)] for _ in range(NUM_PIECE_KINDS)], dtype=np.uint64)
+ZOBRIST_KEYS = ZOBRIST.tolist()
+
+
+def move_key(codes: list[int], move: chess.Move) -> int:
+    """
+        What pushing move XORs into the Zobrist key of a state with piece codes codes (indexed by square)
+        Belief boards carry no ep square, so there is no en passant; castling is the king moving two files
+    """
+    if not move:
+        return 0
+
+    from_square, to_square = move.from_square, move.to_square
+    moved_code = codes[from_square]
+    colour_offset = 0 if moved_code <= chess.KING else chess.KING
+    arriving_code = move.promotion + colour_offset if move.promotion else moved_code
+
+    delta = ZOBRIST_KEYS[moved_code][from_square] ^ ZOBRIST_KEYS[arriving_code][to_square] ^ ZOBRIST_KEYS[codes[to_square]][to_square]
+
+    if moved_code == chess.KING + colour_offset and abs(to_square - from_square) == 2:
+        rook_code = chess.ROOK + colour_offset
+        kingside = to_square > from_square
+        delta ^= ZOBRIST_KEYS[rook_code][to_square + 1 if kingside else to_square - 2]
+        delta ^= ZOBRIST_KEYS[rook_code][to_square - 1 if kingside else to_square + 1]
+
+    return delta
+
+
+def sense_pattern(sense_result: list[tuple[chess.Square, chess.Piece | None]]) -> tuple[int, tuple[int, ...]]:
+    """
+        Converts a sense result into (window mask, expected bitboards)
+        A state agrees with the sense iff bitboard i & window == expected[i] for all 12 piece bitboards
+    """
+    window = chess.BB_EMPTY
+    expected = [chess.BB_EMPTY] * NUM_PIECE_KINDS
+
+    for square, piece in sense_result:
+        window |= chess.BB_SQUARES[square]
+        if piece is not None:
+            expected[piece_index(piece)] |= chess.BB_SQUARES[square]
+
+    return window, tuple(expected)
+
+
+def matches_pattern(state: State, pattern: tuple[int, tuple[int, ...]]) -> bool:
+    window, expected = pattern
+    for bitboard, expected_bitboard in zip(STATE_FORMAT.unpack(state), expected):
+        if bitboard & window != expected_bitboard:
+            return False
+
+    return True
+
+
+def pattern_mismatches(state: State, pattern: tuple[int, tuple[int, ...]]) -> int:
+    """
+        Mask of the window squares where state disagrees with the sense pattern
+    """
+    window, expected = pattern
+    mismatches = chess.BB_EMPTY
+    for bitboard, expected_bitboard in zip(STATE_FORMAT.unpack(state), expected):
+        mismatches |= (bitboard & window) ^ expected_bitboard
+
+    return mismatches
+
+
+# Piece codes used by the array backend: 0 empty, 1-6 white pawn-king, 7-12 black pawn-king (piece_index + 1)
+NUM_PIECE_CODES = NUM_PIECE_KINDS + 1
+
+
+def piece_code(piece: chess.Piece | None) -> int:
+    return 0 if piece is None else piece_index(piece) + 1
+
+
+def state_bitboards(states: list[State]) -> np.ndarray:
+    return np.frombuffer(b"".join(states), dtype="<u8").reshape(-1, NUM_PIECE_KINDS)
+
+
+def bitboard_states(bitboards: np.ndarray) -> list[State]:
+    """
+        Inverse of state_bitboards
+    """
+    packed = np.ascontiguousarray(bitboards, dtype="<u8").tobytes()
+    return [packed[start:start + STATE_FORMAT.size] for start in range(0, len(packed), STATE_FORMAT.size)]
+
+
+def state_codes(states: list[State]) -> np.ndarray:
+    """
+        (N, 64) int8 array of piece codes, indexed by chess.Square
+    """
+    bitboards = state_bitboards(states)
+    codes = np.zeros((len(states), 64), dtype=np.int8)
+
+    for index in range(NUM_PIECE_KINDS):
+        column = np.ascontiguousarray(bitboards[:, index], dtype="<u8").view(np.uint8).reshape(-1, 8)
+        # Piece bitboards are disjoint so each square picks up at most one code
+        codes += np.unpackbits(column, axis=1, bitorder="little").view(np.int8) * np.int8(index + 1)
+
+    return codes
+
+
+def code_states(codes: np.ndarray) -> list[State]:
+    """
+        Inverse of state_codes
+    """
+    bitboards = np.empty((len(codes), NUM_PIECE_KINDS), dtype="<u8")
+    for index in range(NUM_PIECE_KINDS):
+        bitboards[:, index] = np.packbits(codes == index + 1, axis=1, bitorder="little").view("<u8").ravel()
+
+    return bitboard_states(bitboards)
+
+
+def castling_rook_squares(move: chess.Move) -> tuple[chess.Square, chess.Square] | None:
+    """
+        (rook from, rook to) if move castles when a king plays it, else None
+        Only a king leaving e1 / e8 two files sideways castles, other two-file moves (a rook f8h8) have no rook to move
+    """
+    if move.from_square not in (chess.E1, chess.E8) or abs(move.to_square - move.from_square) != 2:
+        return None
+
+    kingside = move.to_square > move.from_square
+    return (move.to_square + 1, move.to_square - 1) if kingside else (move.to_square - 2, move.to_square + 1)
+
+
+def moved_squares(move: chess.Move) -> list[chess.Square]:
+    """
+        Squares moved_codes can change for move
+    """
+    rook_squares = castling_rook_squares(move)
+    return [move.from_square, move.to_square] + (list(rook_squares) if rook_squares is not None else [])
+
+
+def moved_codes(codes: np.ndarray, move: chess.Move) -> np.ndarray:
+    """
+        Piece codes of the states with piece codes codes after move is pushed in every one of them
+        As on the belief boards there is no en passant, and castling is the king moving two files with the rook
+        jumping over it from the corner (move must be applicable, so a castling rook is always in its corner)
+    """
+    codes = codes.copy()
+    if not move:
+        return codes
+
+    moved_code = codes[:, move.from_square].copy()
+    arriving_code = moved_code
+    if move.promotion:
+        arriving_code = np.where(moved_code <= chess.KING, move.promotion, move.promotion + chess.KING).astype(np.int8)
+
+    codes[:, move.from_square] = 0
+    codes[:, move.to_square] = arriving_code
+
+    rook_squares = castling_rook_squares(move)
+    if rook_squares is not None:
+        castling = np.isin(moved_code, [piece_code(chess.Piece(chess.KING, colour)) for colour in chess.COLORS])
+        if castling.any():
+            rook_from, rook_to = rook_squares
+            codes[castling, rook_to] = codes[castling, rook_from]
+            codes[castling, rook_from] = 0
+
+    return codes
+
+
+def state_keys(codes: np.ndarray) -> np.ndarray:
+    """
+        (N,) uint64 Zobrist keys of the states with piece codes codes
+    """
+    keys = np.zeros(len(codes), dtype=np.uint64)
+    for square in range(64):
+        keys ^= ZOBRIST[codes[:, square], square]
+
+    return keys
+
+
+def satisfying(codes: np.ndarray, clauses: list[list[tuple[chess.Square, list[int]]]]) -> np.ndarray:
+    """
+        Mask of the rows of codes meeting every clause, where a clause is met if any of its (square, piece codes) holds
+    """
+    mask = np.ones(len(codes), dtype=bool)
+    for clause in clauses:
+        clause_mask = np.zeros(len(codes), dtype=bool)
+        for square, square_codes in clause:
+            clause_mask |= np.isin(codes[:, square], square_codes)
+        mask &= clause_mask
+
+    return mask
+
+
+class ArrayBelief:
+    """
+        Belief backend holding the states alongside an (N, 64) int8 array of their piece codes
+        Observations become boolean masks over columns of the array and a compaction of both, instead of a check of
+        every state in turn. Agents switch to it with array_belief
+    """
+    def __init__(self, states: list, codes: np.ndarray):
+        assert(len(states) == codes.shape[0])
+        self.states = states
+        self.codes = codes
+
+    @classmethod
+    def from_states(cls, states) -> "ArrayBelief":
+        states = list(states)
+        return cls(states, state_codes(states))
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def __iter__(self):
+        return iter(self.states)
+
+    def keep(self, mask: np.ndarray) -> int:
+        """
+            Drops every state where mask is False, returns the number of states removed
+        """
+        before_size = len(self.states)
+        self.states = list(itertools.compress(self.states, mask))
+        self.codes = self.codes[mask]
+
+        return before_size - len(self.states)
+
+    def sense_mask(self, sense_result: list[tuple[chess.Square, chess.Piece | None]]) -> np.ndarray:
+        squares = [square for square, _ in sense_result]
+        expected = np.array([piece_code(piece) for _, piece in sense_result], dtype=np.int8)
+
+        return np.all(self.codes[:, squares] == expected, axis=1)
+
+    def filter_sense(self, sense_result: list[tuple[chess.Square, chess.Piece | None]]) -> int:
+        return self.keep(self.sense_mask(sense_result))
+
+
+def square_counts(codes: np.ndarray) -> np.ndarray:
+    """
+        (64, 13) array with the number of states holding each piece code on each square
+    """
+    offset_codes = codes + np.arange(0, 64 * NUM_PIECE_CODES, NUM_PIECE_CODES, dtype=np.int16)
+    return np.bincount(offset_codes.ravel(), minlength=64 * NUM_PIECE_CODES).reshape(64, NUM_PIECE_CODES)
+
+
+def kept_counts(counts: np.ndarray, codes: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """
+        square_counts of the rows of codes where mask is True, from counts = square_counts(codes)
+        Subtracts the dropped rows or recounts the kept ones, whichever are fewer
+    """
+    num_kept = np.count_nonzero(mask)
+    if num_kept < len(mask) - num_kept:
+        return square_counts(codes[mask])
+
+    return counts - square_counts(codes[~mask])
+
+
+def recount_squares(counts: np.ndarray, codes: np.ndarray, squares: list[chess.Square]) -> np.ndarray:
+    """
+        counts with the rows of squares counted again from codes, the rest left as they are
+    """
+    counts = counts.copy()
+    for square in set(squares):
+        counts[square] = np.bincount(codes[:, square], minlength=NUM_PIECE_CODES)
+
+    return counts
+
+
+def square_entropy(probabilities: np.ndarray) -> np.ndarray:
+    """
+        Shannon entropy (bits) of the piece distribution on each of the 64 squares
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        terms = np.where(probabilities > 0, probabilities * np.log2(probabilities), 0.0)
+
+    return -terms.sum(axis=1)
+
+
+def window_sum(values: np.ndarray) -> np.ndarray:
+    """
+        8x8 array where each square holds the sum of values over its 3x3 sense window
+        Windows are clipped at the edge of the board rather than wrapping onto the next rank
+    """
+    padded = np.zeros((10, 10))
+    padded[1:9, 1:9] = np.reshape(values, (8, 8))
+
+    windows = np.zeros((8, 8))
+    for rank_shift in range(3):
+        for file_shift in range(3):
+            windows += padded[rank_shift:rank_shift + 8, file_shift:file_shift + 8]
+
+    return windows
+
+
+def rank_nibbles(codes: np.ndarray) -> np.ndarray:
+    """
+        (8, N) array holding each state's ranks with the 8 codes of a rank packed a nibble each, file a lowest
+    """
+    ranks = np.ascontiguousarray(codes).view("<u8").astype(np.uint64)
+    ranks |= ranks >> np.uint64(4)
+    ranks &= np.uint64(0x00FF00FF00FF00FF)
+    ranks |= ranks >> np.uint64(8)
+    ranks &= np.uint64(0x0000FFFF0000FFFF)
+    ranks |= ranks >> np.uint64(16)
+    ranks &= np.uint64(0x00000000FFFFFFFF)
+
+    return np.ascontiguousarray(ranks.T)
+
+
+SEGMENT_SHIFTS = np.arange(0, 24, 4, dtype=np.uint64)[:, None]
+SEGMENT_MASK = np.uint64(0xFFF)
+
+
+def sense_information_gain(codes: np.ndarray, weights: np.ndarray | None = None, deadline: float | None = None) -> np.ndarray | None:
+    """
+        8x8 array with the expected information gain (bits) of sensing each interior square, 0 on the edges
+
+        Sensing a square partitions the states by the joint contents of its 3x3 window, the gain is the entropy of that
+        partition (weighted by weights when given). Codes fit in a nibble, so a window is an exact 36 bit key built from
+        3 rank segments of 12 bits. Each window's keys are sorted once and the partition read off the runs of equal keys
+
+        Returns None if time.time() passes deadline before every rank is scored
+    """
+    gains = np.zeros((8, 8))
+    num_states = len(codes)
+    if num_states == 0:
+        return gains
+
+    ranks = rank_nibbles(codes)
+    windows = np.empty((6, num_states), dtype=np.uint64)
+    segments = np.empty((6, num_states), dtype=np.uint64)
+    total_weight = num_states if weights is None else weights.sum()
+    for rank in range(1, 7):
+        if deadline is not None and time.time() > deadline:
+            return None
+
+        # Windows centred on files b-g of this rank, built in place
+        np.right_shift(ranks[rank - 1], SEGMENT_SHIFTS, out=windows)
+        windows &= SEGMENT_MASK
+        for above, shift in ((rank, np.uint64(12)), (rank + 1, np.uint64(24))):
+            np.right_shift(ranks[above], SEGMENT_SHIFTS, out=segments)
+            segments &= SEGMENT_MASK
+            segments <<= shift
+            windows |= segments
+
+        for file in range(6):
+            keys = windows[file]
+            if weights is None:
+                keys.sort()
+                starts = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+                sizes = np.bincount(np.diff(starts, prepend=0, append=num_states))
+                present = np.flatnonzero(sizes)
+                gains[rank, file + 1] = np.log2(num_states) - (sizes[present] * present * np.log2(present)).sum() / num_states
+            else:
+                order = np.argsort(keys)
+                keys = keys[order]
+                starts = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+                probabilities = np.add.reduceat(weights[order], np.concatenate(([0], starts))) / total_weight
+                probabilities = probabilities[probabilities > 0]
+                gains[rank, file + 1] = -(probabilities * np.log2(probabilities)).sum()
+
+    return gains
+
+
+class Belief(ArrayBelief):
+    """
+        Duplicate free list of states held alongside the (N, 64) piece code array of ArrayBelief, plus per-square
+        piece counts
+
+        Codes and counts are worked out once, when states enter the belief. Observations drop states through masks
+        over the code array (keep) and the counts follow by subtracting the dropped rows, or recounting the kept ones
+        when that is fewer. A move carries them over to the successors (see apply_move), so the piece distribution at
+        sense time is read off the counts rather than taken over the states
+    """
+    def __init__(self, states=(), codes: np.ndarray | None = None, counts: np.ndarray | None = None):
+        if codes is None:
+            states = list(states) if isinstance(states, (set, frozenset)) else list(dict.fromkeys(states))
+            codes = state_codes(states)
+        else:
+            # Caller already has the piece codes (and maybe counts) of a duplicate free batch of states
+            states = list(states)
+
+        super().__init__(states, codes)
+        self.counts = square_counts(codes) if counts is None else counts
+
+    def keep(self, mask: np.ndarray) -> int:
+        mask = np.asarray(mask, dtype=bool)
+        self.counts = kept_counts(self.counts, self.codes, mask)
+
+        return super().keep(mask)
+
+    def probabilities(self) -> np.ndarray | None:
+        """
+            (64, 13) array of the probability of each piece code on each square, None for an empty belief
+        """
+        if len(self.states) == 0:
+            return None
+
+        return self.counts / len(self.states)
+
+
+class ParticleBelief:
+    """
+        Belief where every state carries a weight (its probability under a uniform model of the opponent's moves)
+
+        Observations reweight the particles (a state inconsistent with an observation gets weight 0 and is dropped)
+        and systematic resampling keeps the number of distinct states within a fixed budget, instead of cutting the
+        belief down with a uniform random sample
+    """
+    def __init__(self, weights: dict[State, float] | None = None):
+        self.weights = weights if weights is not None else {}
+        self.normalise()
+
+    @classmethod
+    def uniform(cls, states) -> "ParticleBelief":
+        return cls(dict.fromkeys(states, 1.0))
+
+    def __len__(self) -> int:
+        return len(self.weights)
+
+    def __iter__(self):
+        return iter(self.weights)
+
+    def __contains__(self, state: State) -> bool:
+        return state in self.weights
+
+    def normalise(self):
+        total = sum(self.weights.values())
+        if total > 0:
+            for state in self.weights:
+                self.weights[state] /= total
+
+    def difference_update(self, states):
+        for state in states:
+            self.weights.pop(state, None)
+        self.normalise()
+
+    def subset(self, states) -> "ParticleBelief":
+        return ParticleBelief({state: self.weights[state] for state in states})
+
+    def probabilities(self) -> np.ndarray | None:
+        """
+            (64, 13) array of the weighted probability of each piece code on each square, None for an empty belief
+        """
+        if len(self.weights) == 0:
+            return None
+
+        states = list(self.weights)
+        codes = state_codes(states) + np.arange(0, 64 * NUM_PIECE_CODES, NUM_PIECE_CODES, dtype=np.int16)
+        weights = np.repeat(np.fromiter(self.weights.values(), dtype=np.float64, count=len(states)), 64)
+
+        return np.bincount(codes.ravel(), weights=weights, minlength=64 * NUM_PIECE_CODES).reshape(64, NUM_PIECE_CODES)
+
+    def resample(self, budget: int, rng: np.random.Generator | None = None) -> int:
+        """
+            Systematic resampling down to at most budget distinct states, a state's new weight is the share of the
+            budget it was drawn for. Does nothing if the belief is already within budget. Returns the number of
+            states dropped
+        """
+        if len(self.weights) <= budget:
+            return 0
+
+        rng = rng if rng is not None else np.random.default_rng()
+
+        states = list(self.weights)
+        cumulative = np.cumsum(np.fromiter(self.weights.values(), dtype=np.float64, count=len(states)))
+        positions = (rng.random() + np.arange(budget)) / budget * cumulative[-1]
+        draws = np.bincount(np.minimum(np.searchsorted(cumulative, positions), len(states) - 1), minlength=len(states))
+
+        before_size = len(self.weights)
+        self.weights = {state: count / budget for state, count in zip(states, draws.tolist()) if count > 0}
+
+        return before_size - len(self.weights)
+
+
+class LazyBelief:
+    """
+        Successor belief stored as (parent id, move) references into the parent states, as parallel arrays of
+        parent ids, from squares, to squares and promotion codes. Nothing is pushed onto a board until materialise:
+        piece codes of the successors on any squares are worked out from the parents' codes and the moves, so
+        sense selection and sense filtering run on the references and only the survivors are ever built
+
+        The same successor can be referenced from several parents, so len counts references rather than states
+    """
+    def __init__(self, parents: list[State], turn: chess.Color, parent_ids: np.ndarray, from_squares: np.ndarray, to_squares: np.ndarray, promotions: np.ndarray):
+        self.parents = parents
+        self.parent_codes = state_codes(parents)
+        self.turn = turn
+
+        self.parent_ids = parent_ids
+        self.from_squares = from_squares
+        self.to_squares = to_squares
+        self.promotions = promotions
+
+    def __len__(self) -> int:
+        return len(self.parent_ids)
+
+    def move(self, index: int) -> chess.Move:
+        promotion = int(self.promotions[index])
+        return chess.Move(int(self.from_squares[index]), int(self.to_squares[index]), promotion=(promotion - 1) % 6 + 1 if promotion else None)
+
+    def successor_codes(self, squares: list[chess.Square]) -> np.ndarray:
+        """
+            (len, len(squares)) int8 array of the successors' piece codes on squares
+        """
+        parent_ids = self.parent_ids
+        from_squares = self.from_squares.astype(np.intp)
+        to_squares = self.to_squares.astype(np.intp)
+
+        codes = self.parent_codes[parent_ids[:, None], np.asarray(squares, dtype=np.intp)[None, :]]
+
+        # Null moves are stored as a1a1
+        moving = from_squares != to_squares
+        moved_code = self.parent_codes[parent_ids, from_squares]
+        arriving_code = np.where(self.promotions != 0, self.promotions, moved_code)
+
+        # Castling moves the king two files, the rook jumps over it from the corner
+        castling = moving & np.isin(moved_code, [piece_code(chess.Piece(chess.KING, colour)) for colour in chess.COLORS]) & (np.abs(to_squares - from_squares) == 2)
+        kingside = to_squares > from_squares
+        rook_from = np.where(kingside, to_squares + 1, to_squares - 2)
+        rook_to = np.where(kingside, to_squares - 1, to_squares + 1)
+        rook_code = self.parent_codes[parent_ids, np.where(castling, rook_from, from_squares)]
+
+        # No en passant: the belief boards never carry an ep square, so a pawn moving diagonally onto an empty
+        # square just moves there, the same as when the successors are pushed in materialise / iter_successors
+
+        for column, square in enumerate(squares):
+            codes[moving & (from_squares == square), column] = 0
+            codes[castling & (rook_from == square), column] = 0
+
+            arriving = moving & (to_squares == square)
+            codes[arriving, column] = arriving_code[arriving]
+            rook_arriving = castling & (rook_to == square)
+            codes[rook_arriving, column] = rook_code[rook_arriving]
+
+        return codes
+
+    def probabilities(self) -> np.ndarray | None:
+        """
+            (64, 13) array of the probability of each piece code on each square over the successor references
+        """
+        if len(self) == 0:
+            return None
+
+        counts = np.zeros((64, NUM_PIECE_CODES), dtype=np.int64)
+        for rank in range(8):
+            squares = list(range(rank * 8, rank * 8 + 8))
+            codes = self.successor_codes(squares) + np.arange(0, 8 * NUM_PIECE_CODES, NUM_PIECE_CODES, dtype=np.int16)
+            counts[rank * 8:rank * 8 + 8] = np.bincount(codes.ravel(), minlength=8 * NUM_PIECE_CODES).reshape(8, NUM_PIECE_CODES)
+
+        return counts / len(self)
+
+    def keep(self, mask: np.ndarray) -> int:
+        before_size = len(self)
+
+        self.parent_ids = self.parent_ids[mask]
+        self.from_squares = self.from_squares[mask]
+        self.to_squares = self.to_squares[mask]
+        self.promotions = self.promotions[mask]
+
+        return before_size - len(self)
+
+    def filter_sense(self, sense_result: list[tuple[chess.Square, chess.Piece | None]]) -> int:
+        squares = [square for square, _ in sense_result]
+        expected = np.array([piece_code(piece) for _, piece in sense_result], dtype=np.int8)
+
+        return self.keep(np.all(self.successor_codes(squares) == expected, axis=1))
+
+    def materialise(self) -> set[State]:
+        board = chess.Board()
+        board.turn = self.turn
+
+        states = set()
+        for index, parent_id in enumerate(self.parent_ids.tolist()):
+            set_board_state(board, self.parents[parent_id])
+            board.push(self.move(index))
+            states.add(board_state(board))
+            board.pop()
+
+        return states
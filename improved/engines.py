@@ -0,0 +1,200 @@
+import asyncio
+import collections
+import chess
+import chess.engine
+
+from improved.belief import board_state
+
+
+def limit_key(limit: chess.engine.Limit) -> tuple:
+    """
+        The parts of limit a cached result has to match exactly, the search time is compared instead (see covers)
+    """
+    return (limit.depth, limit.nodes, limit.mate)
+
+
+def covers(searched: chess.engine.Limit, requested: chess.engine.Limit) -> bool:
+    """
+        Whether a result searched with limit searched is at least as deep a search as requested asks for
+        (a search without a time limit covers any time)
+    """
+    if searched.time is None:
+        return True
+    if requested.time is None:
+        return False
+
+    return searched.time >= requested.time
+
+
+class EngineCache:
+    """
+        LRU cache of engine results keyed by (call, position, side to move, castling, en passant, search limit)
+        Shared by every engine an agent drives (its single engine and the EnginePool), with one cache of
+        engine_cache_size entries per game, so a state searched by select_best_states, choose_move or on a previous
+        turn is only sent to stockfish once per limit
+
+        The time of the search limit is not part of the key: the time manager hands out a different per state time
+        every turn, so a result is reused whenever it was searched for at least as long as the lookup asks for
+
+        Hits and misses are counted per call, select_best_states analyses every state of a large belief once a
+        turn and its lookups would otherwise swamp the hit rate of the play lookups choose_move makes
+    """
+    def __init__(self, max_size: int = 100_000):
+        self.max_size = max_size
+        self.results = collections.OrderedDict()
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    def __len__(self) -> int:
+        return len(self.results)
+
+    @staticmethod
+    def key(call: str, board: chess.Board, limit: chess.engine.Limit) -> tuple:
+        return (call, board_state(board), board.turn, board.castling_rights, board.ep_square, limit_key(limit))
+
+    def get(self, key: tuple, limit: chess.engine.Limit):
+        entry = self.results.get(key)
+        if entry is None or not covers(entry[0], limit):
+            self.misses[key[0]] += 1
+            return None
+
+        self.hits[key[0]] += 1
+        self.results.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: tuple, limit: chess.engine.Limit, result):
+        self.results[key] = (limit, result)
+        self.results.move_to_end(key)
+        if len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+
+    def stats(self) -> dict:
+        """
+            Hits, misses and hit rate of each call looked up, with the number of cached results
+        """
+        stats = {}
+        for call in sorted(self.hits.keys() | self.misses.keys()):
+            lookups = self.hits[call] + self.misses[call]
+            stats[call] = {
+                "hits": self.hits[call],
+                "misses": self.misses[call],
+                "hit_rate": self.hits[call] / lookups,
+            }
+        stats["size"] = len(self.results)
+
+        return stats
+
+
+class CachedEngine:
+    """
+        Wraps a SimpleEngine so that play and analyse go through an EngineCache
+    """
+    def __init__(self, engine: chess.engine.SimpleEngine, cache: EngineCache):
+        self.engine = engine
+        self.cache = cache
+
+    def play(self, board: chess.Board, limit: chess.engine.Limit) -> chess.engine.PlayResult:
+        key = EngineCache.key("play", board, limit)
+        result = self.cache.get(key, limit)
+        if result is None:
+            result = self.engine.play(board, limit)
+            self.cache.put(key, limit, result)
+
+        return result
+
+    def analyse(self, board: chess.Board, limit: chess.engine.Limit) -> chess.engine.InfoDict:
+        key = EngineCache.key("analyse", board, limit)
+        result = self.cache.get(key, limit)
+        if result is None:
+            result = self.engine.analyse(board, limit)
+            self.cache.put(key, limit, result)
+
+        return result
+
+    def quit(self):
+        self.engine.quit()
+
+
+class EnginePool:
+    """
+        Several UCI engine processes driven through python-chess's asyncio engine API
+        A batch of positions is spread over the engines and searched concurrently, instead of one position at a
+        time on a single SimpleEngine. The pool owns its event loop, so it can be called from the (synchronous)
+        reconchess callbacks.
+
+        Agents create one of engine_pool_size engines for choose_move, which otherwise searches its states one at a
+        time on the agent's own engine
+    """
+    def __init__(self, engine_path: str, num_engines: int, cache: EngineCache | None = None, **popen_args):
+        assert(num_engines > 0)
+        self.engine_path = engine_path
+        self.popen_args = popen_args
+        self.cache = cache
+
+        self.loop = asyncio.new_event_loop()
+        self.engines = self.loop.run_until_complete(self._popen_all(num_engines))
+
+    def __len__(self) -> int:
+        return len(self.engines)
+
+    async def _popen(self) -> chess.engine.Protocol:
+        _, engine = await chess.engine.popen_uci(self.engine_path, **self.popen_args)
+        return engine
+
+    async def _popen_all(self, num_engines: int) -> list[chess.engine.Protocol]:
+        return list(await asyncio.gather(*(self._popen() for _ in range(num_engines))))
+
+    async def _play_all(self, boards: list[chess.Board], limit: chess.engine.Limit) -> list[chess.engine.PlayResult | None]:
+        idle_engines = asyncio.Queue()
+        for engine in self.engines:
+            idle_engines.put_nowait(engine)
+
+        async def play(board: chess.Board) -> chess.engine.PlayResult | None:
+            engine = await idle_engines.get()
+            try:
+                return await engine.play(board, limit)
+            except chess.engine.EngineTerminatedError:
+                # Replace the dead engine so the rest of the batch still has somewhere to run
+                self.engines.remove(engine)
+                engine = await self._popen()
+                self.engines.append(engine)
+                return None
+            except chess.engine.EngineError:
+                return None
+            finally:
+                idle_engines.put_nowait(engine)
+
+        return await asyncio.gather(*(play(board) for board in boards))
+
+    def play_many(self, boards: list[chess.Board], limit: chess.engine.Limit) -> list[chess.engine.PlayResult | None]:
+        """
+            Plays every board with limit, results are in the same order as boards (None where the engine failed)
+            Boards must be distinct objects, they are read while other searches are running
+        """
+        if len(boards) == 0:
+            return []
+
+        if self.cache is None:
+            return self.loop.run_until_complete(self._play_all(boards, limit))
+
+        keys = [EngineCache.key("play", board, limit) for board in boards]
+        results = [self.cache.get(key, limit) for key in keys]
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        searched = self.loop.run_until_complete(self._play_all([boards[i] for i in missing], limit))
+        for i, result in zip(missing, searched):
+            results[i] = result
+            if result is not None:
+                self.cache.put(keys[i], limit, result)
+
+        return results
+
+    def quit(self):
+        async def quit_all():
+            await asyncio.gather(*(engine.quit() for engine in self.engines), return_exceptions=True)
+
+        try:
+            self.loop.run_until_complete(quit_all())
+        finally:
+            self.engines = []
+            self.loop.close()
@@ -0,0 +1,166 @@
+import contextlib
+import functools
+import json
+import sys
+import time
+import numpy as np
+
+# Histogram bins for durations, in seconds: 10 per decade from 0.1ms to 100s
+DURATION_BINS = np.logspace(-4, 2, 61)
+
+
+class Instrument:
+    """
+        Records the wall time of every rc.Player callback of an agent, the time spent in named stages inside it
+        (expansion, filtering, sense scoring, engine search, ...) and the belief size before and after it
+
+        One record per callback call:
+            {"callback", "move", "seconds", "states_before", "states_after", "stages": {stage: seconds}}
+    """
+    def __init__(self, agent: str = "", colour: str = ""):
+        self.agent = agent
+        self.colour = colour
+        self.records = []
+        self.current = None
+        self.save_path = None
+
+    def begin(self, callback: str, move: int, states_before: int) -> dict:
+        self.current = {
+            "callback": callback,
+            "move": move,
+            "seconds": 0.0,
+            "states_before": states_before,
+            "states_after": states_before,
+            "stages": {},
+        }
+        return self.current
+
+    def end(self, record: dict, seconds: float, states_after: int):
+        record["seconds"] = seconds
+        record["states_after"] = states_after
+        self.records.append(record)
+        self.current = None
+
+        if self.save_path is not None:
+            self.save(self.save_path)
+            self.save_path = None
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.current is not None:
+                stages = self.current["stages"]
+                stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
+
+    def to_dict(self) -> dict:
+        return {
+            "agent": self.agent,
+            "colour": self.colour,
+            "records": self.records,
+            "summary": summarise([self.records]),
+        }
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    def save_after(self, path: str):
+        """
+            Saves to path once the callback being recorded ends (straight away outside of one), so its own record
+            is in the file
+        """
+        if self.current is None:
+            self.save(path)
+        else:
+            self.save_path = path
+
+
+def stage(instrument: Instrument | None, name: str):
+    """
+        instrument.stage(name), or a no-op when the agent is not instrumented
+    """
+    return instrument.stage(name) if instrument is not None else contextlib.nullcontext()
+
+
+def instrumented(method):
+    """
+        Decorator for the callbacks of an agent with an instrument attribute (None turns recording off), a current_move
+        and a states belief. Calls made from inside another recorded callback (choose_move calling itself) are folded into it
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        instrument = self.instrument
+        if instrument is None or instrument.current is not None:
+            return method(self, *args, **kwargs)
+
+        record = instrument.begin(method.__name__, self.current_move, len(self.states))
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            instrument.end(record, time.perf_counter() - start, len(self.states))
+
+    return wrapper
+
+
+def duration_summary(durations: list[float]) -> dict:
+    values = np.asarray(durations)
+    counts, _ = np.histogram(values, bins=DURATION_BINS)
+    return {
+        "count": len(values),
+        "total": float(values.sum()),
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "max": float(values.max()),
+        "histogram": counts.tolist(),
+    }
+
+
+def summarise(games: list[list[dict]]) -> dict:
+    """
+        Aggregates the records of one or more games into per callback and per stage duration summaries
+        (histogram counts are over DURATION_BINS) and per callback belief sizes
+    """
+    callbacks = {}
+    stages = {}
+    sizes = {}
+    for records in games:
+        for record in records:
+            callbacks.setdefault(record["callback"], []).append(record["seconds"])
+            sizes.setdefault(record["callback"], []).append(record["states_after"])
+            for name, seconds in record["stages"].items():
+                stages.setdefault(name, []).append(seconds)
+
+    return {
+        "bins": DURATION_BINS.tolist(),
+        "callbacks": {name: duration_summary(durations) for name, durations in callbacks.items()},
+        "stages": {name: duration_summary(durations) for name, durations in stages.items()},
+        "states_after": {name: {"mean": float(np.mean(values)), "max": int(np.max(values))} for name, values in sizes.items()},
+    }
+
+
+def print_summary(summary: dict):
+    print(f"{'Callback / stage': <28}|\tCalls\tTotal s\tMean ms\tp50 ms\tp90 ms\tMax ms\tStates after (mean / max)")
+    print(f"{'-':-<28}|{'-':-<83}")
+    for kind in ("callbacks", "stages"):
+        for name, row in summary[kind].items():
+            label = name if kind == "callbacks" else f"  {name}"
+            states = summary["states_after"].get(name) if kind == "callbacks" else None
+            states_str = f"{states['mean']:.0f} / {states['max']}" if states is not None else ""
+            print(f"{label: <28}|\t{row['count']}\t{row['total']:.3f}\t{row['mean'] * 1000:.1f}\t{row['p50'] * 1000:.1f}\t{row['p90'] * 1000:.1f}\t{row['max'] * 1000:.1f}\t{states_str}")
+    print(f"{'-':-<112}")
+
+
+if __name__ == "__main__":
+    # python -m improved.instrument <game json> ... : aggregate the per game exports of an instrumented agent
+    games = []
+    for path in sys.argv[1:]:
+        with open(path) as f:
+            games.append(json.load(f)["records"])
+
+    print(f"{len(games)} games")
+    print_summary(summarise(games))
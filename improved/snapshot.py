@@ -0,0 +1,142 @@
+import json
+import struct
+import time
+import chess
+import numpy as np
+
+from improved.belief import Belief, ParticleBelief, LazyBelief, state_bitboards, bitboard_states, NUM_PIECE_KINDS
+
+# Snapshot file layout (little endian):
+#   magic | header length (uint32) | JSON header | zero padding up to DATA_ALIGNMENT
+#   | (num states, 12) uint64 state bitboards | (num states,) float64 weights if the belief is weighted
+# The arrays are aligned so they can be memory mapped straight out of the file instead of read and parsed
+MAGIC = b"RBCSNAP1"
+DATA_ALIGNMENT = 64
+
+
+def aligned(offset: int) -> int:
+    return (offset + DATA_ALIGNMENT - 1) // DATA_ALIGNMENT * DATA_ALIGNMENT
+
+
+def encode_argument(value):
+    """
+        JSON friendly form of a reconchess callback argument: moves as UCI, pieces as symbols, squares as ints
+    """
+    if isinstance(value, chess.Move):
+        return value.uci()
+    elif isinstance(value, chess.Piece):
+        return value.symbol()
+    elif isinstance(value, (list, tuple)):
+        return [encode_argument(item) for item in value]
+
+    return value
+
+
+def encode_arguments(arguments: dict) -> dict:
+    return {name: encode_argument(value) for name, value in arguments.items()}
+
+
+def decode_arguments(arguments: dict) -> dict:
+    """
+        Inverse of encode_arguments for the arguments of the rc.Player callbacks
+    """
+    decoded = dict(arguments)
+    for name in ("requested_move", "taken_move"):
+        if decoded.get(name) is not None:
+            decoded[name] = chess.Move.from_uci(decoded[name])
+    if "move_actions" in decoded:
+        decoded["move_actions"] = [chess.Move.from_uci(move) for move in decoded["move_actions"]]
+    if "sense_result" in decoded:
+        decoded["sense_result"] = [(square, chess.Piece.from_symbol(piece) if piece is not None else None) for square, piece in decoded["sense_result"]]
+
+    return decoded
+
+
+def save_snapshot(path: str, states, metadata: dict):
+    """
+        Writes states (a Belief, ParticleBelief or LazyBelief) and metadata (anything json serialisable) to path
+        A LazyBelief is materialised first, so the snapshot holds the belief the agent would act on
+    """
+    if isinstance(states, LazyBelief):
+        states = states.materialise()
+
+    weights = None
+    if isinstance(states, ParticleBelief):
+        ordered_states = list(states.weights)
+        weights = np.fromiter(states.weights.values(), dtype="<f8", count=len(ordered_states))
+    else:
+        ordered_states = list(states)
+
+    header = dict(metadata, num_states=len(ordered_states), weighted=weights is not None, saved_at=time.time())
+    header_bytes = json.dumps(header).encode("utf-8")
+
+    prefix = MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes
+    with open(path, "wb") as f:
+        f.write(prefix)
+        f.write(b"\0" * (aligned(len(prefix)) - len(prefix)))
+        f.write(np.ascontiguousarray(state_bitboards(ordered_states), dtype="<u8").tobytes())
+        if weights is not None:
+            f.write(weights.tobytes())
+
+
+class Snapshot:
+    """
+        A snapshot file opened with its arrays memory mapped, so even a huge belief loads without being read in full
+
+        metadata -> the JSON header written by save_snapshot
+        bitboards -> (num states, 12) uint64 memmap of the states
+        weights -> (num states,) float64 memmap of the particle weights, or None
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a belief snapshot")
+            (header_length,) = struct.unpack("<I", f.read(4))
+            self.metadata = json.loads(f.read(header_length).decode("utf-8"))
+
+        num_states = self.metadata["num_states"]
+        data_offset = aligned(len(MAGIC) + 4 + header_length)
+
+        self.bitboards = np.memmap(path, dtype="<u8", mode="r", offset=data_offset, shape=(num_states, NUM_PIECE_KINDS)) if num_states != 0 else np.zeros((0, NUM_PIECE_KINDS), dtype=np.uint64)
+        self.weights = None
+        if self.metadata["weighted"] and num_states != 0:
+            self.weights = np.memmap(path, dtype="<f8", mode="r", offset=data_offset + self.bitboards.nbytes, shape=(num_states,))
+
+    def __len__(self) -> int:
+        return self.metadata["num_states"]
+
+    def arguments(self) -> dict:
+        """
+            Arguments the snapshotted callback was called with, so it can be called again on a restored agent
+        """
+        return decode_arguments(self.metadata.get("arguments", {}))
+
+    def states(self) -> list:
+        return bitboard_states(self.bitboards)
+
+    def belief(self) -> Belief | ParticleBelief:
+        states = self.states()
+        if self.weights is not None:
+            return ParticleBelief(dict(zip(states, self.weights.tolist())))
+
+        return Belief(states)
+
+
+def load_snapshot(path: str) -> Snapshot:
+    return Snapshot(path)
+
+
+def load_agent(path: str, agent_class, **agent_args):
+    """
+        Builds a fresh agent_class(**agent_args), starts its game as the snapshot's colour and restores the snapshot into it
+        Returns (agent, snapshot); the caller ends the game (handle_game_end) to shut its engines down
+    """
+    snapshot = load_snapshot(path)
+
+    agent = agent_class(**agent_args)
+    agent.handle_game_start(snapshot.metadata["colour"], chess.Board(snapshot.metadata["my_board"]), snapshot.metadata.get("opponent_name", "snapshot"))
+    agent.restore_snapshot(snapshot)
+
+    return agent, snapshot
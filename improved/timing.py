@@ -0,0 +1,107 @@
+import math
+import time
+
+EXPAND = "expand"
+SENSE = "sense"
+MOVE = "move"
+
+# Stages in the order the reconchess callbacks run them within a turn
+STAGES = (EXPAND, SENSE, MOVE)
+
+DEFAULT_STAGE_SHARES = {
+    EXPAND: 0.3,
+    SENSE: 0.1,
+    MOVE: 0.6,
+}
+
+
+class TimeManager:
+    """
+        Turns the reconchess clock into per stage budgets for the current turn
+
+        Only choose_sense and choose_move are told how much time is left, so the clock is tracked between
+        them: it runs from start_turn/observe_clock until end_turn and is frozen while the opponent plays.
+
+        turn budget = (seconds left - reserve) / max(min_moves_left, expected_moves - move number)
+        stage budget = time left in the turn * stage share / shares of the stages still to run
+        so time an early stage does not use carries over to the later ones
+
+        The clock is unknown until the first observe_clock unless seconds_per_game is given. A turn started before
+        that has no budget until the clock comes in, which only leaves the first expansion unbounded
+    """
+    def __init__(self, seconds_per_game: float | None = None, expected_moves: int = 50, min_moves_left: int = 10, reserve: float = 2.0, stage_shares: dict[str, float] | None = None):
+        self.expected_moves = expected_moves
+        self.min_moves_left = min_moves_left
+        self.reserve = reserve
+        self.stage_shares = stage_shares if stage_shares is not None else DEFAULT_STAGE_SHARES
+
+        self.clock = seconds_per_game
+        self.clock_started = None
+
+        self.move_number = 0
+        self.turn_started = time.time()
+        self.turn_deadline = math.inf
+
+    def seconds_left(self) -> float | None:
+        if self.clock is None or self.clock_started is None:
+            return self.clock
+
+        return self.clock - (time.time() - self.clock_started)
+
+    def observe_clock(self, seconds_left: float):
+        """
+            Resynchronise with the seconds_left passed to choose_sense or choose_move
+        """
+        if self.clock is None:
+            # First sight of the clock, budget the turn as if it had been known when the turn started
+            self.set_turn_deadline(seconds_left + (time.time() - self.turn_started))
+
+        self.clock = seconds_left
+        self.clock_started = time.time()
+        self.turn_deadline = min(self.turn_deadline, time.time() + max(0.0, seconds_left - self.reserve))
+
+    def start_turn(self, move_number: int):
+        self.turn_started = time.time()
+        self.move_number = move_number
+
+        if self.clock is None:
+            self.turn_deadline = math.inf
+            return
+
+        self.clock_started = self.turn_started
+        self.set_turn_deadline(self.clock)
+
+    def set_turn_deadline(self, seconds_left: float):
+        moves_left = max(self.min_moves_left, self.expected_moves - self.move_number)
+        self.turn_deadline = self.turn_started + max(0.0, seconds_left - self.reserve) / moves_left
+
+    def end_turn(self):
+        self.clock = self.seconds_left()
+        self.clock_started = None
+
+    def budget(self, stage: str) -> float:
+        """
+            Seconds the stage gets if it starts now
+        """
+        later_shares = sum(self.stage_shares[later] for later in STAGES[STAGES.index(stage):])
+        return max(0.0, self.turn_deadline - time.time()) * self.stage_shares[stage] / later_shares
+
+    def deadline(self, stage: str) -> float:
+        """
+            time.time() by which the stage should be finished if it starts now
+            (wall clock rather than perf_counter so it can be handed to worker processes)
+        """
+        return time.time() + self.budget(stage)
+
+    @staticmethod
+    def per_state_time(seconds: float, num_states: int, min_time: float, parallelism: int = 1) -> tuple[float, int]:
+        """
+            Splits seconds of wall clock over num_states searches running parallelism at a time
+            Returns (seconds per state, number of states that fit), giving each state at least min_time
+        """
+        budget = max(0.0, seconds) * parallelism
+        if num_states == 0:
+            return budget, 0
+
+        num_fit = min(num_states, max(1, int(budget / min_time)))
+        return max(min_time, budget / num_fit), num_fit
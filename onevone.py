@@ -1,4 +1,3 @@
-import reconchess as rc
 from reconchess.bots.random_bot import RandomBot
 from reconchess.bots.trout_bot import TroutBot
 from baseline2 import RandomSensing
@@ -6,19 +5,39 @@ from baseline2 import RandomSensing
 # from improved2 import NonPrunedEntropic
 # from improved3 import FishyEntropy
 from improved.attempt4 import OpeningFishyEntropy
-from improved.attempt5 import SomethingClever
+from improved.attempt5 import ImprovedAgent
+from ratings import play_game, append_record, sprt, sprt_bounds
 
+from datetime import datetime
 import sys
-import traceback
 
-if len(sys.argv) == 3:
-    num_rounds = int(sys.argv[1])
+# python onevone.py [rounds] [seconds per game] [results.jsonl]
+# python onevone.py sprt <seconds per game> [elo0] [elo1] [alpha] [beta] [max rounds] [results.jsonl]
+# Every game is appended to the results file (results/onevone-<time>.jsonl by default), see ratings.py
+#
+# The sprt mode plays until a sequential probability ratio test decides between H0: players[1] is elo0 stronger than
+# players[0] and H1: it is elo1 stronger (defaults 0 and 50 Elo, at alpha = beta = 0.05), or max rounds run out
+# A lopsided match is over in a handful of games, a close one keeps going until it is resolved
+
+sprt_mode = len(sys.argv) > 1 and sys.argv[1] == "sprt"
+if sprt_mode:
     game_length = float(sys.argv[2])
+    elo0 = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+    elo1 = float(sys.argv[4]) if len(sys.argv) > 4 else 50
+    alpha = float(sys.argv[5]) if len(sys.argv) > 5 else 0.05
+    beta = float(sys.argv[6]) if len(sys.argv) > 6 else 0.05
+    num_rounds = int(sys.argv[7]) if len(sys.argv) > 7 else 1000
+    results_path = sys.argv[8] if len(sys.argv) > 8 else f"results/onevone-{datetime.now():%Y%m%d-%H%M%S}.jsonl"
 else:
-    num_rounds = int(input("Number of rounds: "))
-    game_length = float(input("Seconds per game: "))
+    if len(sys.argv) >= 3:
+        num_rounds = int(sys.argv[1])
+        game_length = float(sys.argv[2])
+    else:
+        num_rounds = int(input("Number of rounds: "))
+        game_length = float(input("Seconds per game: "))
+    results_path = sys.argv[3] if len(sys.argv) > 3 else f"results/onevone-{datetime.now():%Y%m%d-%H%M%S}.jsonl"
 
-players = [TroutBot, SomethingClever]
+players = [TroutBot, ImprovedAgent]
 
 game_rotations = [
     [(0,1)],
@@ -31,6 +50,12 @@ for player in players:
         "draw": 0, "win": 0, "loss": 0
     }
 
+if sprt_mode:
+    lower, upper = sprt_bounds(alpha, beta)
+    print(f"SPRT {players[1].__qualname__} vs {players[0].__qualname__}: elo0 = {elo0:g}, elo1 = {elo1:g}, alpha = {alpha:g}, beta = {beta:g}, LLR bounds [{lower:.2f}, {upper:.2f}]")
+
+decision = None
+rounds_played = 0
 for i in range(num_rounds):
     game_idx = i % len(game_rotations)
     game_rotation = game_rotations[game_idx]
@@ -41,32 +66,51 @@ for i in range(num_rounds):
         subgame = game_rotation.index(game)
         print(f"{i + 1}.{subgame + 1}\t{players[game[0]].__qualname__: <16}\t{players[game[1]].__qualname__: <16}", end="", flush=True)
 
-        try:
-            game_result, win_reason, _ = rc.play_local_game(players[game[0]](), players[game[1]](), seconds_per_player=game_length)
-            if game_result is None:
-                game_result_str = "Draw"
-                game_results[players[game[0]]]["draw"] += 1
-                game_results[players[game[1]]]["draw"] += 1
-            elif game_result:
-                game_result_str = "White"
-                game_results[players[game[0]]]["win"] += 1
-                game_results[players[game[1]]]["loss"] += 1
-            else:
-                game_result_str = "Black"
-                game_results[players[game[0]]]["loss"] += 1
-                game_results[players[game[1]]]["win"] += 1
+        record = play_game(players[game[0]], players[game[1]], game_length)
+        append_record(results_path, dict(record, game=f"{i + 1}.{subgame + 1}"))
+        if record["error"] is not None:
+            print("\t(Error - Failed)")
+            print(record["error"], end="")
+            continue
 
-            print(f"\t{game_result_str: <8}\t{win_reason}")
-        except BaseException as e:
-            print(f"(Error - Failed - {e})")
-            traceback.print_exc()
+        if record["winner"] is None:
+            game_result_str = "Draw"
+            game_results[players[game[0]]]["draw"] += 1
+            game_results[players[game[1]]]["draw"] += 1
+        elif record["winner"] == "white":
+            game_result_str = "White"
+            game_results[players[game[0]]]["win"] += 1
+            game_results[players[game[1]]]["loss"] += 1
+        else:
+            game_result_str = "Black"
+            game_results[players[game[0]]]["loss"] += 1
+            game_results[players[game[1]]]["win"] += 1
+
+        print(f"\t{game_result_str: <8}\t{record['win_reason']}")
 
     print(f"{'-':-<90}")
+    rounds_played += 1
+
+    if sprt_mode:
+        # Wins, draws and losses of players[1], the agent under test
+        candidate = game_results[players[1]]
+        llr, decision = sprt(candidate["win"], candidate["draw"], candidate["loss"], elo0, elo1, alpha, beta)
+        print(f"LLR {llr:.2f}\t[{lower:.2f}, {upper:.2f}]")
+        if decision is not None:
+            break
 
 print(f"{'-':-<64}")
 print(f"{'Agent Results': <20}|\tScore\tWins\tLosses\tDraws\tWin %")
 print(f"{'-':-<20}|{'-':-<43}")
 for agent in players:
     score = game_results[agent]['win'] * 1 + game_results[agent]['draw'] * 0.5
-    print(f"{agent.__qualname__: <20}|\t{score}\t{game_results[agent]['win']}\t{game_results[agent]['loss']}\t{game_results[agent]['draw']}\t{game_results[agent]['win'] / num_rounds * 100:.2f}")
+    print(f"{agent.__qualname__: <20}|\t{score}\t{game_results[agent]['win']}\t{game_results[agent]['loss']}\t{game_results[agent]['draw']}\t{game_results[agent]['win'] / rounds_played * 100:.2f}")
 print(f"{'-':-<64}")
+if sprt_mode:
+    if decision == "H1":
+        print(f"H1 accepted after {rounds_played} rounds: {players[1].__qualname__} is at least {elo1:g} Elo stronger than {players[0].__qualname__}")
+    elif decision == "H0":
+        print(f"H0 accepted after {rounds_played} rounds: {players[1].__qualname__} is not {elo1:g} Elo stronger than {players[0].__qualname__}")
+    else:
+        print(f"No decision after {rounds_played} rounds")
+print(f"Results written to {results_path}")
@@ -0,0 +1,257 @@
+import reconchess as rc
+import chess
+import numpy as np
+
+from datetime import datetime
+import json
+import math
+import sys
+import time
+import traceback
+
+# Machine readable tournament results and the ratings computed from them
+#
+# The runners append one JSON object per game to a .jsonl results file:
+#   {"white", "black", "winner": "white" | "black" | null, "score": white's score (1, 0.5, 0), "win_reason",
+#    "turns", "seconds_per_player", "white_seconds_left", "black_seconds_left", "duration", "finished_at", "error"}
+# A game that failed has an "error" (its traceback) and is left out of the ratings
+#
+#   python ratings.py <results.jsonl> ...
+# fits Elo ratings (BayesElo style: maximum a posteriori Bradley-Terry with a first move advantage and a Gaussian
+# prior) to every game in the files and prints them with 95% confidence intervals and the likelihood of superiority
+#
+# sprt() is the sequential test onevone.py uses to stop a match as soon as its outcome is clear
+
+# Elo points per natural log unit of the logistic model, P(i beats j) = 1 / (1 + 10^((r_j - r_i) / 400))
+ELO_SCALE = 400 / math.log(10)
+
+# Standard deviation of the prior on each rating (and on the first move advantage), in Elo
+# Keeps the ratings finite for agents that won or lost every game, while barely moving them once there are a few games
+PRIOR_ELO = 400
+
+
+def play_game(white_player: type, black_player: type, seconds_per_player: float = 900) -> dict:
+    """
+        Plays white_player() against black_player() and returns the game's result record
+        The LocalGame is passed into rc.play_local_game so the clocks can be read once the game is over
+    """
+    record = {
+        "white": white_player.__qualname__,
+        "black": black_player.__qualname__,
+        "winner": None,
+        "score": None,
+        "win_reason": None,
+        "turns": 0,
+        "seconds_per_player": seconds_per_player,
+        "white_seconds_left": None,
+        "black_seconds_left": None,
+        "duration": 0.0,
+        "finished_at": None,
+        "error": None,
+    }
+
+    start = time.perf_counter()
+    try:
+        game = rc.LocalGame(seconds_per_player=seconds_per_player)
+        winner_color, win_reason, game_history = rc.play_local_game(white_player(), black_player(), game=game)
+
+        record["winner"] = None if winner_color is None else ("white" if winner_color else "black")
+        record["score"] = 0.5 if winner_color is None else float(winner_color)
+        record["win_reason"] = None if win_reason is None else win_reason.name
+        record["turns"] = game_history.num_turns()
+        record["white_seconds_left"] = game.seconds_left_by_color[chess.WHITE]
+        record["black_seconds_left"] = game.seconds_left_by_color[chess.BLACK]
+    except Exception:
+        record["error"] = traceback.format_exc()
+
+    record["duration"] = time.perf_counter() - start
+    record["finished_at"] = datetime.now().isoformat(timespec="seconds")
+    return record
+
+
+def append_record(path: str, record: dict):
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def load_records(paths: list[str]) -> list[dict]:
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+
+    return records
+
+
+def finished_games(records: list[dict]) -> list[dict]:
+    return [record for record in records if record.get("error") is None and record.get("score") is not None]
+
+
+def fit_ratings(records: list[dict], prior_elo: float = PRIOR_ELO, iterations: int = 50) -> dict:
+    """
+        Fits a rating per agent and a first move advantage to the finished games in records by Newton's method on the
+        log posterior (draws count as half a win and half a loss). The covariance of the estimate is the inverse of the
+        negative Hessian at the optimum, so the intervals are the usual Laplace approximation
+
+        Returns {"agents", "ratings", "covariance", "advantage", "advantage_sd", "games", "scores"} with the ratings
+        centred on a mean of 0 Elo and the covariance being that of the centred ratings
+        Raises ValueError when no game in records finished
+    """
+    games = finished_games(records)
+    if len(games) == 0:
+        raise ValueError("No finished games to rate")
+
+    agents = sorted({record["white"] for record in games} | {record["black"] for record in games})
+    index = {agent: i for i, agent in enumerate(agents)}
+    num_agents = len(agents)
+
+    white = np.array([index[record["white"]] for record in games], dtype=int)
+    black = np.array([index[record["black"]] for record in games], dtype=int)
+    score = np.array([record["score"] for record in games], dtype=float)
+
+    # Parameters: one rating per agent then the advantage, all in natural log units
+    # Each game's logit is design @ parameters, design rows being +1 for white, -1 for black and +1 for the advantage
+    design = np.zeros((len(games), num_agents + 1))
+    design[np.arange(len(games)), white] += 1
+    design[np.arange(len(games)), black] -= 1
+    design[:, num_agents] = 1
+
+    prior_precision = (ELO_SCALE / prior_elo) ** 2
+    parameters = np.zeros(num_agents + 1)
+    hessian = -prior_precision * np.eye(num_agents + 1)
+    for _ in range(iterations):
+        expected = 1 / (1 + np.exp(-(design @ parameters)))
+        gradient = design.T @ (score - expected) - prior_precision * parameters
+        hessian = -(design.T * (expected * (1 - expected))) @ design - prior_precision * np.eye(num_agents + 1)
+
+        step = np.linalg.solve(hessian, gradient)
+        parameters -= step
+        if np.max(np.abs(step)) < 1e-9:
+            break
+
+    covariance = np.linalg.inv(-hessian) * ELO_SCALE ** 2
+
+    # Only rating differences are identified by the games, report them about the mean agent
+    centring = np.eye(num_agents) - 1 / num_agents
+    ratings = centring @ parameters[:num_agents] * ELO_SCALE
+
+    scores = np.zeros(num_agents)
+    np.add.at(scores, white, score)
+    np.add.at(scores, black, 1 - score)
+
+    return {
+        "agents": agents,
+        "ratings": ratings,
+        "covariance": centring @ covariance[:num_agents, :num_agents] @ centring.T,
+        "advantage": parameters[num_agents] * ELO_SCALE,
+        "advantage_sd": math.sqrt(covariance[num_agents, num_agents]),
+        "games": np.bincount(white, minlength=num_agents) + np.bincount(black, minlength=num_agents),
+        "scores": scores,
+    }
+
+
+def likelihood_of_superiority(fit: dict) -> np.ndarray:
+    """
+        [i, j] -> probability that agent i is stronger than agent j under the fitted (Gaussian) posterior
+    """
+    ratings = fit["ratings"]
+    covariance = fit["covariance"]
+    variances = np.diag(covariance)
+
+    num_agents = len(ratings)
+    superiority = np.full((num_agents, num_agents), 0.5)
+    for i in range(num_agents):
+        for j in range(num_agents):
+            if i == j:
+                continue
+            sd = math.sqrt(max(variances[i] + variances[j] - 2 * covariance[i, j], 1e-12))
+            superiority[i, j] = 0.5 * (1 + math.erf((ratings[i] - ratings[j]) / (sd * math.sqrt(2))))
+
+    return superiority
+
+
+def print_ratings(fit: dict):
+    agents = fit["agents"]
+    order = np.argsort(-fit["ratings"])
+    errors = 1.96 * np.sqrt(np.diag(fit["covariance"]))
+
+    print(f"{'-':-<72}")
+    print(f"{'Agent': <20}|\tElo\t95% CI\tGames\tScore\tScore %")
+    print(f"{'-':-<20}|{'-':-<51}")
+    for i in order:
+        print(f"{agents[i]: <20}|\t{fit['ratings'][i]:.0f}\t±{errors[i]:.0f}\t{fit['games'][i]}\t{fit['scores'][i]}\t{fit['scores'][i] / max(fit['games'][i], 1) * 100:.2f}")
+    print(f"{'-':-<72}")
+    print(f"First move advantage: {fit['advantage']:.0f} ±{1.96 * fit['advantage_sd']:.0f} Elo")
+
+    superiority = likelihood_of_superiority(fit)
+    print()
+    print(f"{'Likelihood of superiority': <28}|\t" + "\t".join(agents[j][:7] for j in order))
+    print(f"{'-':-<28}|{'-':-<{8 * len(agents)}}")
+    for i in order:
+        print(f"{agents[i]: <28}|\t" + "\t".join("" if i == j else f"{superiority[i, j] * 100:.1f}" for j in order))
+    print(f"{'-':-<{29 + 8 * len(agents)}}")
+
+
+def sprt_bounds(alpha: float, beta: float) -> tuple[float, float]:
+    """
+        (lower, upper) log likelihood ratio bounds of an SPRT with false positive rate alpha and false negative rate beta
+        Crossing the lower bound accepts H0, crossing the upper bound accepts H1
+    """
+    return math.log(beta / (1 - alpha)), math.log((1 - beta) / alpha)
+
+
+def expected_score(elo: float) -> float:
+    return 1 / (1 + 10 ** (-elo / 400))
+
+
+def sprt_llr(wins: int, draws: int, losses: int, elo0: float, elo1: float) -> float:
+    """
+        Log likelihood ratio of H1 (the agent is elo1 stronger) against H0 (it is elo0 stronger) after the agent scored
+        wins / draws / losses. Generalised SPRT on the trinomial game outcome: the likelihood of each hypothesis is
+        approximated with the observed score variance, so draws are accounted for without a draw model
+
+        Half a game is added to each outcome when estimating the mean and variance, otherwise the variance of a match
+        the agent has so far won every game of is 0 and a single game would decide the test
+    """
+    num_games = wins + draws + losses
+    if num_games == 0:
+        return 0.0
+
+    regularised = np.array([wins, draws, losses], dtype=float) + 0.5
+    outcomes = np.array([1, 0.5, 0])
+    mean = regularised @ outcomes / regularised.sum()
+    variance = regularised @ (outcomes - mean) ** 2 / regularised.sum()
+
+    score0 = expected_score(elo0)
+    score1 = expected_score(elo1)
+    return num_games * (score1 - score0) * (2 * mean - score0 - score1) / (2 * variance)
+
+
+def sprt(wins: int, draws: int, losses: int, elo0: float, elo1: float, alpha: float, beta: float) -> tuple[float, str | None]:
+    """
+        (log likelihood ratio, "H0" | "H1" once a bound has been crossed, else None)
+    """
+    llr = sprt_llr(wins, draws, losses, elo0, elo1)
+    lower, upper = sprt_bounds(alpha, beta)
+    if llr <= lower:
+        return llr, "H0"
+    elif llr >= upper:
+        return llr, "H1"
+
+    return llr, None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage:\tpython ratings.py <results.jsonl> ...")
+        sys.exit(1)
+
+    records = load_records(sys.argv[1:])
+    failed = sum(record.get("error") is not None for record in records)
+    print(f"{len(records)} games from {len(sys.argv) - 1} files ({failed} failed and left out)")
+    if len(finished_games(records)) == 0:
+        print("No finished games, nothing to rate")
+        sys.exit(1)
+
+    fit = fit_ratings(records)
+    print_ratings(fit)
@@ -0,0 +1,127 @@
+import reconchess as rc
+import reconchess.utilities as rcu
+from reconchess.bots.random_bot import RandomBot
+from reconchess.bots.trout_bot import TroutBot
+from baseline2 import RandomSensing
+from improved.attempt1 import EntropicSense
+from improved.attempt4 import OpeningFishyEntropy
+from improved.attempt5 import ImprovedAgent
+
+import chess
+import random
+import sys
+import time
+
+# Replays the observations one side got in a recorded game into any agent, timing every callback
+#
+#   python replay.py record <history.json> <white agent> <black agent> [seconds per player] [seed]
+#   python replay.py run <history.json> <white|black> <agent> [repeats] [seed] [seconds left]
+#
+# The recorded sense results and move results are fed back whatever the agent chooses, so every agent (and every
+# version of an agent) sees exactly the same inputs and only the time it takes to handle them differs
+
+agents = {
+    "RandomBot": RandomBot,
+    "TroutBot": TroutBot,
+    "RandomSensing": RandomSensing,
+    "EntropicSense": EntropicSense,
+    "OpeningFishyEntropy": OpeningFishyEntropy,
+    "ImprovedAgent": ImprovedAgent,
+}
+
+CALLBACKS = [
+    "handle_game_start",
+    "handle_opponent_move_result",
+    "choose_sense",
+    "handle_sense_result",
+    "choose_move",
+    "handle_move_result",
+    "handle_game_end",
+]
+
+
+def record_game(white_player: rc.Player, black_player: rc.Player, path: str, seconds_per_player: float = 900) -> rc.GameHistory:
+    _, _, game_history = rc.play_local_game(white_player, black_player, seconds_per_player=seconds_per_player)
+    game_history.save(path)
+    return game_history
+
+
+def replay_game(game_history: rc.GameHistory, colour: chess.Color, player: rc.Player, seconds_left: float = 900) -> dict[str, list[float]]:
+    """
+        Plays colour's side of game_history into player, returns the seconds taken by each call of each callback
+        seconds_left is what choose_sense and choose_move are told on every turn, so time managed agents budget the
+        same way on every replay
+    """
+    timings = {callback: [] for callback in CALLBACKS}
+
+    def timed(callback: str, *args):
+        start = time.perf_counter()
+        result = getattr(player, callback)(*args)
+        timings[callback].append(time.perf_counter() - start)
+        return result
+
+    opponent_name = game_history.get_black_player_name() if colour == chess.WHITE else game_history.get_white_player_name()
+    timed("handle_game_start", colour, chess.Board(), opponent_name)
+
+    for turn in game_history.turns(color=colour):
+        if game_history.is_first_turn(turn):
+            opponent_capture_square = None
+        else:
+            opponent_capture_square = game_history.capture_square(turn.previous)
+        timed("handle_opponent_move_result", opponent_capture_square is not None, opponent_capture_square)
+
+        if not game_history.has_move(turn):
+            # The game ended part way through this turn (e.g. on time), there is nothing more to replay
+            break
+
+        move_actions = rcu.move_actions(game_history.truth_board_before_move(turn))
+
+        timed("choose_sense", list(chess.SQUARES), move_actions, seconds_left)
+        timed("handle_sense_result", game_history.sense_result(turn) if game_history.has_sense(turn) else [])
+
+        timed("choose_move", move_actions, seconds_left)
+        capture_square = game_history.capture_square(turn)
+        timed("handle_move_result", game_history.requested_move(turn), game_history.taken_move(turn), capture_square is not None, capture_square)
+
+    timed("handle_game_end", game_history.get_winner_color(), game_history.get_win_reason(), game_history)
+
+    return timings
+
+
+def print_timings(timings: dict[str, list[float]]):
+    print(f"{'Callback': <28}|\tCalls\tTotal s\tMean ms\tMax ms")
+    print(f"{'-':-<28}|{'-':-<43}")
+    for callback, durations in timings.items():
+        if len(durations) == 0:
+            continue
+        print(f"{callback: <28}|\t{len(durations)}\t{sum(durations):.3f}\t{sum(durations) / len(durations) * 1000:.1f}\t{max(durations) * 1000:.1f}")
+    print(f"{'-':-<72}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 5 or sys.argv[1] not in ("record", "run"):
+        print("Usage:\tpython replay.py record <history.json> <white agent> <black agent> [seconds per player] [seed]")
+        print("\tpython replay.py run <history.json> <white|black> <agent> [repeats] [seed] [seconds left]")
+        print(f"Agents:\t{', '.join(agents)}")
+        sys.exit(1)
+
+    history_path = sys.argv[2]
+
+    if sys.argv[1] == "record":
+        game_length = float(sys.argv[5]) if len(sys.argv) > 5 else 900
+        random.seed(int(sys.argv[6]) if len(sys.argv) > 6 else 0)
+
+        game_history = record_game(agents[sys.argv[3]](), agents[sys.argv[4]](), history_path, game_length)
+        print(f"Recorded {game_history.num_turns()} turns to {history_path}: winner {game_history.get_winner_color()} by {game_history.get_win_reason()}")
+    else:
+        colour = sys.argv[3].lower() == "white"
+        agent = agents[sys.argv[4]]
+        num_repeats = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+        seed = int(sys.argv[6]) if len(sys.argv) > 6 else 0
+        seconds_left = float(sys.argv[7]) if len(sys.argv) > 7 else 900
+
+        game_history = rc.GameHistory.from_file(history_path)
+        for repeat in range(num_repeats):
+            random.seed(seed)
+            print(f"Replay {repeat + 1}: {agent.__qualname__} as {sys.argv[3].lower()} over {game_history.num_turns(colour)} turns")
+            print_timings(replay_game(game_history, colour, agent(), seconds_left))
@@ -1,4 +1,3 @@
-import reconchess as rc
 from reconchess.bots.random_bot import RandomBot
 from reconchess.bots.trout_bot import TroutBot
 from baseline2 import RandomSensing
@@ -6,19 +5,21 @@ from baseline2 import RandomSensing
 # from improved2 import NonPrunedEntropic
 # from improved3 import FishyEntropy
 from improved.attempt4 import OpeningFishyEntropy
-from improved.attempt5 import SomethingClever
+from improved.attempt5 import ImprovedAgent
+from ratings import play_game, append_record
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+import os
 import sys
 import traceback
 
-if len(sys.argv) == 3:
-    num_rounds = int(sys.argv[1])
-    game_length = float(sys.argv[2])
-else:
-    num_rounds = int(input("Number of rounds: "))
-    game_length = float(input("Seconds per game: "))
+# python roundrobin.py [rounds] [seconds per game] [workers] [results.jsonl]
+# Games are independent, so they are played in a pool of worker processes (one per core by default), each game
+# building its own agents and so its own Stockfish processes. Results are printed as the games finish and appended to
+# the results file (results/roundrobin-<time>.jsonl by default), see ratings.py
 
-players = [TroutBot, OpeningFishyEntropy, SomethingClever, RandomSensing]
+players = [TroutBot, OpeningFishyEntropy, ImprovedAgent, RandomSensing]
 
 game_rotations = [
     [(0, 1), (2, 3)],
@@ -31,29 +32,53 @@ game_rotations = [
     [(3, 0), (2, 1)],
 ]
 
-game_results = {}
-for player in players:
-    game_results[player] = {
-        "draw": 0, "win": 0, "loss": 0
-    }
 
-for i in range(num_rounds):
-    game_idx = i % len(game_rotations)
-    game_rotation = game_rotations[game_idx]
+if __name__ == "__main__":
+    if len(sys.argv) >= 3:
+        num_rounds = int(sys.argv[1])
+        game_length = float(sys.argv[2])
+    else:
+        num_rounds = int(input("Number of rounds: "))
+        game_length = float(input("Seconds per game: "))
+    num_workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    results_path = sys.argv[4] if len(sys.argv) > 4 else f"results/roundrobin-{datetime.now():%Y%m%d-%H%M%S}.jsonl"
+
+    game_results = {}
+    for player in players:
+        game_results[player] = {
+            "draw": 0, "win": 0, "loss": 0
+        }
 
     print(f"Game\t{'White': <16}\t{'Black': <16}\t{'Result': <8}\tReason")
     print(f"{'-':-<90}")
-    for game in game_rotation:
-        subgame = game_rotation.index(game)
-        print(f"{i + 1}.{subgame + 1}\t{players[game[0]].__qualname__: <16}\t{players[game[1]].__qualname__: <16}", end="", flush=True)
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        games = {}
+        for i in range(num_rounds):
+            game_rotation = game_rotations[i % len(game_rotations)]
+            for subgame, game in enumerate(game_rotation):
+                games[pool.submit(play_game, players[game[0]], players[game[1]], game_length)] = (f"{i + 1}.{subgame + 1}", game)
+
+        for future in as_completed(games):
+            game_id, game = games[future]
+            print(f"{game_id}\t{players[game[0]].__qualname__: <16}\t{players[game[1]].__qualname__: <16}", end="")
+
+            try:
+                record = future.result()
+            except BaseException:
+                # The worker itself died (e.g. killed or out of memory), not just the game
+                record = {"white": players[game[0]].__qualname__, "black": players[game[1]].__qualname__, "error": traceback.format_exc()}
+            append_record(results_path, dict(record, game=game_id))
+
+            if record["error"] is not None:
+                print("\t(Error - Failed)")
+                print(record["error"], end="", flush=True)
+                continue
 
-        try:
-            game_result, win_reason, _ = rc.play_local_game(players[game[0]](), players[game[1]](), seconds_per_player=game_length)
-            if game_result is None:
+            if record["winner"] is None:
                 game_result_str = "Draw"
                 game_results[players[game[0]]]["draw"] += 1
                 game_results[players[game[1]]]["draw"] += 1
-            elif game_result:
+            elif record["winner"] == "white":
                 game_result_str = "White"
                 game_results[players[game[0]]]["win"] += 1
                 game_results[players[game[1]]]["loss"] += 1
@@ -62,17 +87,15 @@ for i in range(num_rounds):
                 game_results[players[game[0]]]["loss"] += 1
                 game_results[players[game[1]]]["win"] += 1
 
-            print(f"\t{game_result_str: <8}\t{win_reason}")
-        except BaseException as e:
-            print(f"(Error - Failed - {e})")
-            traceback.print_exc()
+            print(f"\t{game_result_str: <8}\t{record['win_reason']}", flush=True)
 
     print(f"{'-':-<90}")
 
-print(f"{'-':-<64}")
-print(f"{'Agent Results': <20}|\tScore\tWins\tLosses\tDraws\tWin %")
-print(f"{'-':-<20}|{'-':-<43}")
-for agent in players:
-    score = game_results[agent]['win'] * 1 + game_results[agent]['draw'] * 0.5
-    print(f"{agent.__qualname__: <20}|\t{score}\t{game_results[agent]['win']}\t{game_results[agent]['loss']}\t{game_results[agent]['draw']}\t{game_results[agent]['win'] / num_rounds * 100:.2f}")
-print(f"{'-':-<64}")
+    print(f"{'-':-<64}")
+    print(f"{'Agent Results': <20}|\tScore\tWins\tLosses\tDraws\tWin %")
+    print(f"{'-':-<20}|{'-':-<43}")
+    for agent in players:
+        score = game_results[agent]['win'] * 1 + game_results[agent]['draw'] * 0.5
+        print(f"{agent.__qualname__: <20}|\t{score}\t{game_results[agent]['win']}\t{game_results[agent]['loss']}\t{game_results[agent]['draw']}\t{game_results[agent]['win'] / num_rounds * 100:.2f}")
+    print(f"{'-':-<64}")
+    print(f"Results written to {results_path}")
@@ -0,0 +1,29 @@
+import random
+import chess
+import pytest
+
+
+def random_boards(num_boards: int, num_plies: int = 30, seed: int = 0) -> list[chess.Board]:
+    """
+        Boards after a random number of random pseudo-legal plies, without an ep square (as belief boards are)
+    """
+    rng = random.Random(seed)
+    boards = []
+    for _ in range(num_boards):
+        board = chess.Board()
+        for _ in range(rng.randrange(num_plies)):
+            moves = list(board.pseudo_legal_moves)
+            if len(moves) == 0 or not board.king(chess.WHITE) or not board.king(chess.BLACK):
+                break
+            board.push(rng.choice(moves))
+
+        board = board.copy(stack=False)
+        board.ep_square = None
+        boards.append(board)
+
+    return boards
+
+
+@pytest.fixture(scope="session")
+def boards() -> list[chess.Board]:
+    return random_boards(200)
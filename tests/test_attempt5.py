@@ -0,0 +1,171 @@
+import random
+import chess
+import chess.engine
+import reconchess.utilities as rcu
+
+from improved.attempt5 import evolve_states, lazy_evolve_states, sense_first_evolve_states, move_result_clauses, filter_move_result, evolve_particles, expand_states, iter_successors, iter_unique_successors, opponent_moves, select_best_states, priority_order, anytime_vote, generate_moves, generate_moves_onto, generate_quiet_moves
+from improved.belief import Belief, ParticleBelief, board_state, set_board_state
+
+
+class MaterialEngine:
+    """
+        Stands in for stockfish: scores a board by its material balance for the side to move
+    """
+    values = {chess.PAWN: 100, chess.KNIGHT: 300, chess.BISHOP: 300, chess.ROOK: 500, chess.QUEEN: 900}
+
+    def analyse(self, board: chess.Board, limit: chess.engine.Limit) -> chess.engine.InfoDict:
+        material = sum(value * (len(board.pieces(piece_type, board.turn)) - len(board.pieces(piece_type, not board.turn))) for piece_type, value in self.values.items())
+        return {"score": chess.engine.PovScore(chess.engine.Cp(material), board.turn)}
+
+
+def state_without(*squares: chess.Square):
+    board = chess.Board()
+    for square in squares:
+        board.remove_piece_at(square)
+
+    return board_state(board)
+
+
+def test_select_best_states_buckets_by_state_evaluation():
+    turn = chess.BLACK
+    worst = state_without(chess.D8)
+    middle = state_without()
+    best = state_without(chess.D1)
+    states = Belief([middle, worst, best, state_without(chess.A2, chess.A7)])
+
+    buckets = {}
+    selected = select_best_states(states, turn, MaterialEngine(), [1, 1, 1], [-400, -200, 200, 400], buckets=buckets)
+
+    assert set(selected) == {worst, middle, best}
+    assert buckets == {worst: 0, middle: 1, best: 2}
+
+    random.seed(0)
+    assert priority_order(selected, buckets) == [best, middle, worst]
+
+
+def test_anytime_vote_weights_votes():
+    moves = [chess.Move.from_uci("e2e4"), chess.Move.from_uci("d2d4"), chess.Move.from_uci("d2d4")]
+    boards = [chess.Board() for _ in moves]
+    board_moves = {id(board): move for board, move in zip(boards, moves)}
+    play_batch = lambda batch: [chess.engine.PlayResult(board_moves[id(board)], None) for board in batch]
+    valid_moves = {"e2e4", "d2d4"}
+
+    assert anytime_vote(boards, play_batch, 1, valid_moves, None) == {"e2e4": 1, "d2d4": 2}
+    assert anytime_vote(boards, play_batch, 1, valid_moves, None, [0.8, 0.1, 0.1]) == {"e2e4": 0.8}
+
+
+def test_generate_quiet_moves_with_a_pawn_on_the_last_rank():
+    # pawn_capture_moves_on leaves pawns unpromoted on the last rank, their pushes must stay on the board
+    board = chess.Board("rnbqkbnP/ppppppp1/8/8/8/8/PPPPPPP1/RNBQKBNR w KQq - 0 1")
+
+    quiet_moves = set(generate_quiet_moves(board))
+    assert quiet_moves == {move for move in generate_moves(board) if not board.occupied_co[chess.BLACK] & chess.BB_SQUARES[move.to_square]}
+
+
+def test_targeted_move_generators_match_generate_moves_without_repeats(boards):
+    for board in boards:
+        all_moves = set(generate_moves(board))
+
+        quiet_moves = generate_quiet_moves(board)
+        assert len(quiet_moves) == len(set(quiet_moves))
+        assert set(quiet_moves) == {move for move in all_moves if not move or not board.occupied_co[not board.turn] & chess.BB_SQUARES[move.to_square]}
+
+        for square in chess.scan_forward(board.occupied_co[not board.turn]):
+            onto_moves = generate_moves_onto(board, square)
+            assert len(onto_moves) == len(set(onto_moves))
+            assert set(onto_moves) == {move for move in all_moves if move and move.to_square == square}
+
+
+def test_evolve_particles_splits_weight_evenly_over_distinct_moves():
+    # Black can castle both ways and capture on d4 with a pawn, the moves repeated before generation was deduplicated
+    board = chess.Board("r3k2r/pppp1ppp/8/4p3/3P4/8/PPP1PPPP/R3K2R b KQkq - 0 1")
+    state = board_state(board)
+
+    for capture_square in (None, chess.D4):
+        moves, _ = opponent_moves(board, capture_square)
+        particles, _ = evolve_particles(ParticleBelief.uniform([state]), chess.BLACK, capture_square)
+
+        assert len(particles) == len(set(moves))
+        assert all(abs(weight - 1 / len(particles)) < 1e-9 for weight in particles.weights.values())
+
+
+def test_unique_successors_with_bounded_keys(boards):
+    states = Belief(board_state(board) for board in boards[:20])
+    successors = set(iter_successors(states, chess.WHITE, None))
+
+    unique_successors = list(iter_unique_successors(states, chess.WHITE, None))
+    assert len(unique_successors) == len(set(unique_successors))
+    assert set(unique_successors) == successors
+
+    # Past max_keys successors may repeat, but none go missing
+    assert set(iter_unique_successors(states, chess.WHITE, None, max_keys=10)) == successors
+
+    capped_states, _ = expand_states(states, chess.WHITE, None, cap=50, zobrist=True)
+    assert len(capped_states) == 50
+    assert capped_states <= successors
+
+
+def opponent_successors(board: chess.Board) -> list[chess.Board]:
+    """
+        Boards after every move the side not to move on board could have made, as the belief would hold them
+    """
+    before = board.copy(stack=False)
+    before.turn = not board.turn
+
+    successors = []
+    for move in generate_moves(before):
+        successor = before.copy(stack=False)
+        successor.push(move)
+        successor.ep_square = None
+        successor.castling_rights = board.castling_rights
+        successors.append(successor)
+
+    return successors
+
+
+def test_move_result_filter_matches_revise_move(boards):
+    rng = random.Random(1)
+    for board in boards:
+        colour = board.turn
+        candidates = [successor for successor in opponent_successors(board) if all(successor.pieces(piece_type, colour) == board.pieces(piece_type, colour) for piece_type in chess.PIECE_TYPES)]
+        states = [board_state(candidate) for candidate in candidates]
+
+        for requested_move in rng.sample(rcu.move_actions(board), 5):
+            taken_move = rcu.revise_move(board, requested_move)
+            capture_square = rcu.capture_square_of_move(board, taken_move)
+            clauses = move_result_clauses(colour, board.piece_type_at(requested_move.from_square), requested_move, taken_move, capture_square)
+
+            kept, num_removed = filter_move_result(Belief(states), clauses)
+            expected = [state for state, candidate in zip(states, candidates) if rcu.revise_move(candidate, requested_move) == taken_move and rcu.capture_square_of_move(candidate, taken_move) == capture_square]
+
+            assert set(kept.states) == set(expected), (board.fen(), requested_move)
+            assert num_removed == len(set(states)) - len(set(expected))
+
+
+def test_deferred_expansions_match_eager_expansion(boards):
+    states = Belief(board_state(board) for board in boards[:40])
+    turn = chess.BLACK
+
+    true_board = chess.Board()
+    true_board.turn = turn
+    for state in states:
+        set_board_state(true_board, state)
+        captures = [move for move in generate_moves(true_board) if move and true_board.occupied_co[not turn] & chess.BB_SQUARES[move.to_square]]
+        if len(captures) != 0:
+            break
+
+    for true_move, capture_square in ((generate_quiet_moves(true_board)[-1], None), (captures[0], captures[0].to_square)):
+        true_board.push(true_move)
+        sense_result = [(square, true_board.piece_at(square)) for square in chess.SquareSet(chess.BB_KING_ATTACKS[true_move.to_square] | chess.BB_SQUARES[true_move.to_square])]
+        true_board.pop()
+
+        eager, _ = evolve_states(states, turn, capture_square)
+        eager.filter_sense(sense_result)
+        assert len(eager) != 0
+
+        lazy, _ = lazy_evolve_states(states, turn, capture_square)
+        lazy.filter_sense(sense_result)
+        assert lazy.materialise() == set(eager.states)
+
+        sense_first, _ = sense_first_evolve_states(states, turn, capture_square, sense_result)
+        assert set(sense_first.states) == set(eager.states)
@@ -0,0 +1,74 @@
+import chess
+import numpy as np
+
+from improved.attempt5 import generate_moves
+from improved.belief import Belief, board_state, set_board_state, state_codes, code_states, piece_code, moved_codes, moved_squares, recount_squares, kept_counts, square_counts, state_keys, move_key, sense_pattern, matches_pattern
+
+
+# Both castles for each side, and rooks / queens moving two files along the back rank (f8h8, d1b1)
+BACK_RANK_FENS = [
+    "r3k2r/pppppppp/8/8/8/8/PPPPPPPP/R3K2R w KQkq - 0 1",
+    "r3k2r/pppppppp/8/8/8/8/PPPPPPPP/R3K2R b KQkq - 0 1",
+    "4kr2/8/8/8/8/8/8/3QK3 b - - 0 1",
+    "4kr2/8/8/8/8/8/8/3QK3 w - - 0 1",
+    "4kq2/8/8/8/8/8/8/3RK3 b - - 0 1",
+    "4kq2/8/8/8/8/8/8/3RK3 w - - 0 1",
+]
+
+
+def board_codes(board: chess.BaseBoard) -> np.ndarray:
+    return np.array([piece_code(board.piece_at(square)) for square in chess.SQUARES], dtype=np.int8)
+
+
+def test_state_round_trips(boards):
+    states = [board_state(board) for board in boards]
+    codes = state_codes(states)
+
+    assert code_states(codes) == states
+    for board, state, row in zip(boards, states, codes):
+        assert np.array_equal(row, board_codes(board))
+
+        restored = chess.Board()
+        set_board_state(restored, state)
+        assert restored.board_fen() == board.board_fen()
+
+
+def test_moved_codes_and_keys_follow_pushed_moves(boards):
+    for board in boards + [chess.Board(fen) for fen in BACK_RANK_FENS]:
+        codes = state_codes([board_state(board)])
+        key = int(state_keys(codes)[0])
+
+        for move in generate_moves(board):
+            pushed = board.copy(stack=False)
+            pushed.push(move)
+            expected = state_codes([board_state(pushed)])
+
+            assert np.array_equal(moved_codes(codes, move), expected), (board.fen(), move)
+            assert key ^ move_key(codes[0].tolist(), move) == int(state_keys(expected)[0]), (board.fen(), move)
+
+
+def test_belief_counts_follow_keep_and_moves(boards):
+    belief = Belief(board_state(board) for board in boards)
+    assert np.array_equal(belief.counts, square_counts(belief.codes))
+
+    belief.keep(np.arange(len(belief)) % 3 != 0)
+    assert np.array_equal(belief.counts, square_counts(belief.codes))
+
+    move = chess.Move(chess.E2, chess.E4)
+    kept = belief.codes[:, chess.E2] == piece_code(chess.Piece(chess.PAWN, chess.WHITE))
+    next_codes = moved_codes(belief.codes[kept], move)
+    next_counts = recount_squares(kept_counts(belief.counts, belief.codes, kept), next_codes, moved_squares(move))
+    assert np.array_equal(next_counts, square_counts(next_codes))
+
+
+def test_sense_filter_matches_sense_pattern(boards):
+    states = [board_state(board) for board in boards]
+    true_board = boards[7]
+    sense_result = [(square, true_board.piece_at(square)) for square in chess.SquareSet(chess.BB_KING_ATTACKS[chess.E6] | chess.BB_SQUARES[chess.E6])]
+
+    belief = Belief(states)
+    belief.filter_sense(sense_result)
+
+    pattern = sense_pattern(sense_result)
+    assert set(belief.states) == {state for state in states if matches_pattern(state, pattern)}
+    assert board_state(true_board) in belief.states
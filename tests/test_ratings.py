@@ -0,0 +1,65 @@
+import random
+import pytest
+
+from ratings import fit_ratings, likelihood_of_superiority, sprt, sprt_bounds, sprt_llr
+
+
+def game(white: str, black: str, score: float | None, error: str | None = None) -> dict:
+    return {"white": white, "black": black, "score": score, "error": error}
+
+
+def simulated_games(strengths: dict[str, float], num_rounds: int, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    records = []
+    for _ in range(num_rounds):
+        for white in strengths:
+            for black in strengths:
+                if white != black:
+                    white_wins = rng.random() < 1 / (1 + 10 ** ((strengths[black] - strengths[white]) / 400))
+                    records.append(game(white, black, float(white_wins)))
+
+    return records
+
+
+def test_fit_ratings_recovers_the_order_of_strengths():
+    fit = fit_ratings(simulated_games({"weak": -200, "middle": 0, "strong": 200}, 100))
+    ratings = dict(zip(fit["agents"], fit["ratings"]))
+
+    assert ratings["strong"] > ratings["middle"] > ratings["weak"]
+    assert abs(sum(fit["ratings"])) < 1e-6
+    assert ratings["strong"] - ratings["weak"] == pytest.approx(400, abs=100)
+    assert list(fit["games"]) == [400, 400, 400]
+
+    superiority = likelihood_of_superiority(fit)
+    strong, weak = fit["agents"].index("strong"), fit["agents"].index("weak")
+    assert superiority[strong, weak] > 0.99
+    assert superiority[strong, weak] + superiority[weak, strong] == pytest.approx(1)
+
+
+def test_fit_ratings_leaves_out_failed_games():
+    records = simulated_games({"a": 0, "b": 0}, 10) + [game("a", "b", None, error="Traceback ...")]
+    assert sum(fit_ratings(records)["games"]) == 2 * 20
+
+    with pytest.raises(ValueError):
+        fit_ratings([game("a", "b", None, error="Traceback ...")])
+
+
+def test_fit_ratings_stays_finite_for_an_unbeaten_agent():
+    fit = fit_ratings([game("a", "b", 1.0), game("b", "a", 0.0)])
+    assert all(abs(rating) < 1000 for rating in fit["ratings"])
+
+
+def test_sprt_llr():
+    assert sprt_llr(0, 0, 0, 0, 50) == 0.0
+    assert sprt_llr(30, 10, 10, 0, 50) > 0
+    assert sprt_llr(10, 10, 30, 0, 50) < 0
+
+    # A single win must not decide the test
+    lower, upper = sprt_bounds(0.05, 0.05)
+    assert lower < sprt_llr(1, 0, 0, 0, 50) < upper
+
+
+def test_sprt_decides_clear_matches():
+    assert sprt(95, 0, 5, 0, 50, 0.05, 0.05)[1] == "H1"
+    assert sprt(5, 0, 95, 0, 50, 0.05, 0.05)[1] == "H0"
+    assert sprt(2, 1, 2, 0, 50, 0.05, 0.05)[1] is None
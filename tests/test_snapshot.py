@@ -0,0 +1,56 @@
+import chess
+import numpy as np
+
+from improved.attempt5 import lazy_evolve_states
+from improved.belief import Belief, ParticleBelief, board_state
+from improved.snapshot import save_snapshot, load_snapshot, encode_arguments, decode_arguments
+
+
+def test_belief_round_trip(boards, tmp_path):
+    states = list(dict.fromkeys(board_state(board) for board in boards))
+    path = str(tmp_path / "belief.snap")
+    save_snapshot(path, Belief(states), {"colour": chess.WHITE, "current_move": 4})
+
+    snapshot = load_snapshot(path)
+    assert len(snapshot) == len(states)
+    assert snapshot.metadata["colour"] == chess.WHITE and snapshot.metadata["current_move"] == 4
+    assert snapshot.states() == states
+    assert np.array_equal(snapshot.belief().codes, Belief(states).codes)
+
+
+def test_particle_belief_round_trip(boards, tmp_path):
+    particles = ParticleBelief({board_state(board): float(i + 1) for i, board in enumerate(boards)})
+    path = str(tmp_path / "particles.snap")
+    save_snapshot(path, particles, {})
+
+    restored = load_snapshot(path).belief()
+    assert isinstance(restored, ParticleBelief)
+    assert list(restored.weights) == list(particles.weights)
+    assert np.allclose(list(restored.weights.values()), list(particles.weights.values()))
+
+
+def test_lazy_belief_is_saved_materialised(boards, tmp_path):
+    lazy, _ = lazy_evolve_states(Belief(board_state(board) for board in boards[:10]), chess.WHITE, None)
+    path = str(tmp_path / "lazy.snap")
+    save_snapshot(path, lazy, {})
+
+    assert set(load_snapshot(path).states()) == lazy.materialise()
+
+
+def test_empty_belief_round_trip(tmp_path):
+    path = str(tmp_path / "empty.snap")
+    save_snapshot(path, Belief(), {})
+
+    assert len(load_snapshot(path).belief()) == 0
+
+
+def test_callback_arguments_round_trip():
+    arguments = {
+        "requested_move": chess.Move.from_uci("e7e8q"),
+        "taken_move": None,
+        "move_actions": [chess.Move.from_uci("e2e4"), chess.Move.from_uci("g1f3")],
+        "sense_result": [(chess.E4, chess.Piece(chess.PAWN, chess.WHITE)), (chess.E5, None)],
+        "seconds_left": 12.5,
+    }
+
+    assert decode_arguments(encode_arguments(arguments)) == arguments